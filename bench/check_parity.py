@@ -0,0 +1,75 @@
+"""
+Перевірка способів розбору на збережених сторінках (bench/fixtures).
+
+Для кожного сайту:
+  * повний розбір (html.parser) має знайти назву і ціну зі сторінки;
+  * якщо для сайту є швидкий шлях (fast_extraction_available), він має спрацювати
+    і дати той самий (заголовок, текст ціни), що й повний розбір;
+  * якщо на сторінці знайшлися структуровані дані, ціна в них має збігатися;
+  * ціна має потрапляти в один із фрагментів, які хешує region_hash, інакше
+    зміну ціни бот не помітить до PAGE_REPARSE_MAX_AGE.
+
+Сайти без швидкого шляху (немає "strainer", а lxml не встановлено) позначаються
+як пропущені. За будь-якої розбіжності скрипт завершується з кодом 1.
+
+Запуск: python bench/check_parity.py
+"""
+import os
+import sys
+from pathlib import Path
+
+# Токен потрібного формату, щоб aiogram дозволив створити Bot; до Telegram ми не звертаємося
+os.environ.setdefault("BOT_TOKEN", "123456:parity-check-token-not-used")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import bot  # noqa: E402
+from shop_server import FIXTURE_PRICES, load_fixtures  # noqa: E402
+
+
+def check_site(site: str, content: bytes):
+    """Повертаємо список знайдених проблем для сторінки сайту (порожній, якщо все гаразд)."""
+    problems = []
+    expected_price = bot.parse_price(FIXTURE_PRICES[site])
+    full = bot.extract_full(content, site)
+    if bot.parse_price(full[1]) != expected_price:
+        problems.append(f"повний розбір дав {full}, очікувана ціна {FIXTURE_PRICES[site]}")
+
+    if bot.fast_extraction_available(site):
+        fast = bot.extract_fast(content, site)
+        if fast is None:
+            problems.append("швидкий розбір не спрацював, хоча сайт має його використовувати")
+        elif fast != full:
+            problems.append(f"швидкий розбір дав {fast}, повний — {full}")
+
+    structured = bot.extract_structured(content, site)
+    if structured is not None and bot.parse_price(structured[1]) != expected_price:
+        problems.append(f"структуровані дані дали {structured}, очікувана ціна {FIXTURE_PRICES[site]}")
+
+    markers = bot.SCRAPING_CONFIG[site].get("region", ())
+    windows = [content[start:start + bot.REGION_HASH_WINDOW]
+               for start in (content.find(marker.encode()) for marker in markers) if start != -1]
+    if len(windows) == len(markers) and not any(
+            price.encode() in window for window in windows
+            for price in (FIXTURE_PRICES[site], FIXTURE_PRICES[site].replace(" ", ""))):
+        problems.append("ціна не потрапляє в жоден фрагмент region_hash")
+    return problems
+
+
+def main():
+    print(f"Парсер швидкого шляху: {bot.FAST_HTML_PARSER}")
+    failed = False
+    for site, html in load_fixtures().items():
+        problems = check_site(site, html.encode("utf-8"))
+        if problems:
+            failed = True
+            for problem in problems:
+                print(f"ПОМИЛКА {site}: {problem}")
+        elif bot.fast_extraction_available(site):
+            print(f"OK {site}")
+        else:
+            print(f"OK {site} (швидкого шляху немає, перевірено лише повний розбір)")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Локальний відправник оновлень Telegram для перевірки режиму webhook.
+
+Скрипт піднімає фальшивий сервер Bot API (відповідає на sendMessage, editMessageText,
+setWebhook тощо і запам'ятовує, коли бот відповів кожному чату) та надсилає на webhook
+бота задану кількість оновлень з командою від різних користувачів. У звіті —
+затримка підтвердження webhook і затримка до першої відповіді бота.
+
+Запуск (у двох терміналах):
+  BOT_TOKEN=123456:test BOT_MODE=webhook WEBHOOK_SECRET=secret \\
+      TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+  python bench/fake_updates.py --webhook http://127.0.0.1:8080/telegram --secret secret --api-port 8081
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+
+
+def latency_stats(samples):
+    """Статистика затримок (секунди на вході, мілісекунди у звіті)."""
+    samples = sorted(sample * 1000 for sample in samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(statistics.fmean(samples), 2),
+        "p50_ms": round(samples[len(samples) // 2], 2),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+        "max_ms": round(samples[-1], 2),
+    }
+
+
+class FakeTelegramAPI:
+    """Сервер, що імітує Bot API: кожен виклик методу успішний."""
+
+    def __init__(self):
+        self.calls = {}
+        self.first_reply_at = {}
+        self._message_ids = 0
+        self._runner = None
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post())
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}})
+        if method not in ("sendMessage", "editMessageText", "sendDocument"):
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(params["chat_id"])
+        self.first_reply_at.setdefault(chat_id, time.perf_counter())
+        self._message_ids += 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": int(params.get("message_id") or self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }})
+
+    async def start(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def make_update(update_id: int, chat_id: int, text: str) -> dict:
+    """Оновлення з текстовим повідомленням від користувача chat_id."""
+    command_length = len(text.split()[0]) if text.startswith("/") else 0
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": command_length}] if command_length else [],
+        },
+    }
+
+
+async def send_updates(args, api: FakeTelegramAPI):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    sent_at = {}
+    ack_latencies = []
+    statuses = {}
+
+    async def send_one(session: aiohttp.ClientSession, number: int):
+        chat_id = args.first_chat_id + number
+        async with semaphore:
+            sent_at[chat_id] = start = time.perf_counter()
+            async with session.post(args.webhook, json=make_update(number + 1, chat_id, args.text),
+                                    headers=headers) as response:
+                await response.read()
+                ack_latencies.append(time.perf_counter() - start)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(send_one(session, number) for number in range(args.updates)))
+    send_seconds = time.perf_counter() - start
+
+    # Чекаємо відповідей бота на всі прийняті оновлення
+    deadline = time.perf_counter() + args.reply_timeout
+    while len(api.first_reply_at) < statuses.get(200, 0) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    reply_latencies = [api.first_reply_at[chat_id] - sent for chat_id, sent in sent_at.items()
+                       if chat_id in api.first_reply_at]
+    return {
+        "updates": args.updates,
+        "concurrency": args.concurrency,
+        "send_seconds": round(send_seconds, 4),
+        "updates_per_second": round(args.updates / send_seconds, 1) if send_seconds else None,
+        "webhook_statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "webhook_ack": latency_stats(ack_latencies) if ack_latencies else None,
+        "replies": len(reply_latencies),
+        "reply": latency_stats(reply_latencies) if reply_latencies else None,
+        "api_calls": dict(sorted(api.calls.items())),
+    }
+
+
+async def run(args):
+    api = FakeTelegramAPI()
+    await api.start(args.api_host, args.api_port)
+    try:
+        report = {"started_at": datetime.now().isoformat(timespec="seconds"), "config": vars(args)}
+        report["results"] = await send_updates(args, api)
+        report["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        return report
+    finally:
+        await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фальшиві оновлення Telegram для webhook бота")
+    parser.add_argument("--webhook", default="http://127.0.0.1:8080/telegram", help="адреса webhook бота")
+    parser.add_argument("--secret", default="", help="значення WEBHOOK_SECRET бота")
+    parser.add_argument("--api-host", default="127.0.0.1")
+    parser.add_argument("--api-port", type=int, default=8081, help="порт фальшивого Bot API (TELEGRAM_API_URL бота)")
+    parser.add_argument("--updates", type=int, default=200, help="скільки оновлень надіслати")
+    parser.add_argument("--concurrency", type=int, default=20, help="скільки запитів до webhook одночасно")
+    parser.add_argument("--text", default="/start", help="текст повідомлення в кожному оновленні")
+    parser.add_argument("--first-chat-id", type=int, default=1_000_000, help="ID першого фальшивого користувача")
+    parser.add_argument("--reply-timeout", type=float, default=60, help="скільки секунд чекати відповідей бота")
+    parser.add_argument("--output", help="файл для JSON-результатів (за замовчуванням stdout)")
+    args = parser.parse_args()
+
+    text = json.dumps(asyncio.run(run(args)), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Офлайн-бенчмарки бота: не потребують мережі та справжнього токена Telegram.
+
+Що вимірюємо:
+  * parse   — розбір збережених сторінок (bench/fixtures), parse_price, відповідність
+              швидкого та повного розбору;
+  * scrape  — scrape_custom проти локального сервера магазинів (bench/shop_server.py),
+              спершу "холодні" запити, потім повторні (ETag / 304);
+  * db      — затримки функцій роботи з базою при різній кількості рядків;
+  * cycle   — повний цикл розсилки для N користувачів × M продуктів з фейковим Bot:
+              без попереднього скрейпінгу і з ним.
+
+Результати виводяться як JSON (у stdout або у файл --output), щоб порівнювати запуски.
+
+Приклад: python bench/run_benchmarks.py --db-rows 10000,100000,1000000 --users 500 --products 5 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+# Токен потрібного формату, щоб aiogram дозволив створити Bot; до Telegram ми не звертаємося
+os.environ.setdefault("BOT_TOKEN", "123456:benchmark-token-not-used")
+WORK_DIR = tempfile.mkdtemp(prefix="pandyvan-bench-")
+os.environ["DB_PATH"] = os.path.join(WORK_DIR, "bench.db")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiohttp  # noqa: E402
+
+import bot  # noqa: E402
+from shop_server import FIXTURE_PRICES, LocalResolver, ShopServer, load_fixtures, product_url  # noqa: E402
+
+SITES = list(FIXTURE_PRICES)
+
+
+class FakeBot:
+    """Замінник aiogram.Bot: нічого не надсилає, лише рахує повідомлення."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.sent = 0
+        self.edits = 0
+        self.chars = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent += 1
+        self.chars += len(text)
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=self.sent)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.edits += 1
+
+
+def timed(func, repeat: int):
+    """Виконуємо func repeat разів; повертаємо статистику затримок у мілісекундах."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return latency_stats(samples)
+
+
+def latency_stats(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(statistics.fmean(samples), 4),
+        "p50_ms": round(samples[len(samples) // 2], 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+        "max_ms": round(samples[-1], 4),
+    }
+
+
+# -------------------- Розбір сторінок -------------------- #
+def bench_parse(repeat: int):
+    fixtures = {site: html.encode("utf-8") for site, html in load_fixtures().items()}
+    results = {"fast_html_parser": bot.FAST_HTML_PARSER, "sites": {}}
+    for site, content in fixtures.items():
+        results["sites"][site] = {
+            "page_bytes": len(content),
+            "fast_path": bot.fast_extraction_available(site),
+            "parity": bot.check_extraction_parity(content, site),
+            "parse_page": timed(lambda: bot.parse_page(content, site), repeat),
+            "extract_full": timed(lambda: bot.extract_full(content, site), repeat),
+            "region_hash": timed(lambda: bot.region_hash(content, site), repeat),
+        }
+
+    price_texts = [f"від{random.randint(1000, 99999):,} грн".replace(",", " ") for _ in range(10000)]
+    start = time.perf_counter()
+    for text in price_texts:
+        bot.parse_price(text)
+    elapsed = time.perf_counter() - start
+    results["parse_price_per_second"] = round(len(price_texts) / elapsed)
+    return results
+
+
+# -------------------- Скрейпінг -------------------- #
+async def bench_scrape(port: int, server: ShopServer, count: int):
+    urls = [(product_url(SITES[i % len(SITES)], i, port), SITES[i % len(SITES)]) for i in range(count)]
+    results = {}
+    for phase in ("cold", "conditional"):
+        requests_before = server.requests
+        start = time.perf_counter()
+        scraped = await asyncio.gather(*(bot.scrape_custom(url, site) for url, site in urls))
+        elapsed = time.perf_counter() - start
+        results[phase] = {
+            "pages": count,
+            "seconds": round(elapsed, 4),
+            "pages_per_second": round(count / elapsed, 2),
+            "failed": sum(1 for title, _, _ in scraped if title is None),
+            "server_requests": server.requests - requests_before,
+        }
+    results["server_not_modified"] = server.not_modified
+    return results
+
+
+# -------------------- База даних -------------------- #
+def _use_database(path: str):
+    """Перемикаємо з'єднання головного потоку на іншу базу даних."""
+    conn = getattr(bot._db_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        del bot._db_local.conn
+    bot.DB_PATH = path
+
+
+def bench_db(row_counts, products_per_user: int, repeat: int):
+    main_db = bot.DB_PATH
+    results = {}
+    for rows in row_counts:
+        _use_database(os.path.join(WORK_DIR, f"db-{rows}.db"))
+        bot.init_db()
+        users = max(1, rows // products_per_user)
+        start = time.perf_counter()
+        with bot.get_db() as conn:
+            conn.executemany(
+                "INSERT INTO tracked_products (user_id, url, title, price, price_value, last_scrape) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (i % users, f"https://fayni-mebli.com/product-{i}.html", f"Продукт {i}",
+                     f"{1000.0 + i}", 1000.0 + i, "2025-01-01 09:00:00")
+                    for i in range(rows)
+                ),
+            )
+        populate_seconds = time.perf_counter() - start
+
+        def random_user():
+            return random.randrange(users)
+
+        batch = [(random.randrange(1, rows + 1), "Продукт", 1234.0, "2025-01-02 09:00:00")
+                 for _ in range(bot.DB_BATCH_SIZE)]
+        results[str(rows)] = {
+            "populate_seconds": round(populate_seconds, 3),
+            "get_products_for_user": timed(lambda: bot.get_products_for_user(random_user()), repeat),
+            "update_tracked_product": timed(
+                lambda: bot.update_tracked_product(random.randrange(1, rows + 1), "Продукт", 1.0, "ts"), repeat),
+            f"update_tracked_products_batch_{len(batch)}": timed(lambda: bot.update_tracked_products(batch),
+                                                                   max(1, repeat // 10)),
+            "add_and_delete_tracked_product": timed(lambda: (
+                bot.add_tracked_product(-1, "https://fayni-mebli.com/new.html", "Новий", 1.0, "ts"),
+                bot.delete_tracked_product(-1, "https://fayni-mebli.com/new.html"),
+            ), repeat),
+        }
+    _use_database(main_db)
+    return results
+
+
+# -------------------- Повний цикл розсилки -------------------- #
+async def _wait_for_scrapes():
+    while bot._scrape_inflight:
+        await asyncio.sleep(0.01)
+
+
+async def bench_cycle(port: int, server: ShopServer, users: int, products: int, distinct_urls: int):
+    fake_bot = FakeBot()
+    bot.bot = fake_bot
+    bucket = "09:00"
+    with bot.get_db() as conn:
+        conn.execute("DELETE FROM tracked_products")
+        conn.execute("DELETE FROM user_settings")
+        conn.execute("DELETE FROM page_cache")
+        conn.executemany("INSERT INTO user_settings (user_id, update_time) VALUES (?, ?)",
+                         ((user_id, bucket) for user_id in range(users)))
+        rows = []
+        for user_id in range(users):
+            for k in range(products):
+                product_id = (user_id * products + k) % distinct_urls
+                site = SITES[product_id % len(SITES)]
+                rows.append((user_id, product_url(site, product_id, port), "Продукт", "1.0", 1.0, "ts"))
+        conn.executemany(
+            "INSERT INTO tracked_products (user_id, url, title, price, price_value, last_scrape) "
+            "VALUES (?, ?, ?, ?, ?, ?)", rows)
+    bot._delivery_semaphore = asyncio.Semaphore(bot.SCHEDULER_CONCURRENCY)
+
+    results = {"users": users, "products_per_user": products, "distinct_urls": distinct_urls}
+
+    # 1. Доставка зі скрейпінгом "наживо"
+    bot._scrape_cache.clear()
+    requests_before, sent_before = server.requests, fake_bot.sent
+    start = time.perf_counter()
+    await bot.dispatch_bucket(bucket)
+    elapsed = time.perf_counter() - start
+    results["live"] = {
+        "seconds": round(elapsed, 4),
+        "server_requests": server.requests - requests_before,
+        "messages_sent": fake_bot.sent - sent_before,
+    }
+
+    # 2. Попередній скрейпінг, після якого доставка лише читає готові результати
+    with bot.get_db() as conn:
+        conn.execute("DELETE FROM page_cache")
+    bot._scrape_cache.clear()
+    prefetch_ahead = bot.PREFETCH_AHEAD_MINUTES
+    bot.PREFETCH_AHEAD_MINUTES = 1  # без розподілу запитів у часі
+    requests_before = server.requests
+    start = time.perf_counter()
+    await bot.prefetch_bucket(bucket, time.time())
+    await _wait_for_scrapes()
+    prefetch_seconds = time.perf_counter() - start
+    bot.PREFETCH_AHEAD_MINUTES = prefetch_ahead
+    prefetch_requests = server.requests - requests_before
+
+    requests_before, sent_before = server.requests, fake_bot.sent
+    start = time.perf_counter()
+    await bot.dispatch_bucket(bucket)
+    elapsed = time.perf_counter() - start
+    results["prefetched"] = {
+        "prefetch_seconds": round(prefetch_seconds, 4),
+        "prefetch_server_requests": prefetch_requests,
+        "delivery_seconds": round(elapsed, 4),
+        "delivery_server_requests": server.requests - requests_before,
+        "messages_sent": fake_bot.sent - sent_before,
+    }
+    return results
+
+
+async def run(args):
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "benchmarks": {},
+    }
+    benchmarks = set(args.only.split(",")) if args.only else {"parse", "scrape", "db", "cycle"}
+
+    if "parse" in benchmarks:
+        report["benchmarks"]["parse"] = bench_parse(args.repeat)
+
+    if "db" in benchmarks:
+        row_counts = [int(value) for value in args.db_rows.split(",") if value]
+        report["benchmarks"]["db"] = bench_db(row_counts, args.products, args.repeat)
+
+    if benchmarks & {"scrape", "cycle"}:
+        await bot.run_db(bot.init_db)
+        if args.no_telegram_limits:
+            bot.TELEGRAM_GLOBAL_RATE = bot.TELEGRAM_CHAT_RATE = bot.TELEGRAM_CHAT_BURST = 1_000_000
+        server = ShopServer(latency=args.latency, error_rate=args.error_rate)
+        port = await server.start()
+        connector = aiohttp.TCPConnector(limit=bot.FETCH_GLOBAL_LIMIT, resolver=LocalResolver())
+        bot._http_session = aiohttp.ClientSession(connector=connector, headers=bot.FETCH_HEADERS)
+        try:
+            if "scrape" in benchmarks:
+                report["benchmarks"]["scrape"] = await bench_scrape(port, server, args.pages)
+            if "cycle" in benchmarks:
+                report["benchmarks"]["cycle"] = await bench_cycle(
+                    port, server, args.users, args.products, args.distinct_urls or args.users * args.products)
+        finally:
+            await bot.close_http_session()
+            await server.stop()
+
+    report["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки pandyvanBot")
+    parser.add_argument("--only", default="", help="через кому: parse,scrape,db,cycle (за замовчуванням усі)")
+    parser.add_argument("--repeat", type=int, default=200, help="повторів для вимірювань затримки")
+    parser.add_argument("--pages", type=int, default=300, help="кількість сторінок для бенчмарку scrape")
+    parser.add_argument("--db-rows", default="10000,100000", help="кількості рядків tracked_products через кому")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--products", type=int, default=5, help="продуктів на користувача")
+    parser.add_argument("--distinct-urls", type=int, default=0,
+                        help="скільки різних URL у циклі (за замовчуванням users × products)")
+    parser.add_argument("--latency", type=float, default=0.02, help="затримка локального сервера, секунд")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="частка відповідей 503")
+    parser.add_argument("--no-telegram-limits", action="store_true",
+                        help="вимкнути ліміти швидкості Telegram, щоб виміряти лише конвеєр бота")
+    parser.add_argument("--output", help="файл для JSON-результатів (за замовчуванням stdout)")
+    args = parser.parse_args()
+
+    random.seed(0)
+    logging.getLogger().setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text, encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Локальний сервер, який підміняє сайти магазинів із SCRAPING_CONFIG під час бенчмарків.
+
+Сторінки беруться з bench/fixtures/<сайт>.html, а ціна кожного продукту
+детерміновано залежить від його номера. Сервер підтримує ETag/If-None-Match,
+штучну затримку відповіді та частку відповідей з помилкою 503.
+Сайт визначається за заголовком Host, тому бот звертається до звичних доменів
+(наприклад, http://pufetto.com.ua:<порт>/product/1), а LocalResolver
+спрямовує їх на 127.0.0.1.
+
+Окремий запуск: python bench/shop_server.py --port 8080 --latency 0.05 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+import socket
+from pathlib import Path
+
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+# Домен кожного сайту, за яким бот визначає налаштування скрейпінгу
+SITE_HOSTS = {
+    "pufetto": "pufetto.com.ua",
+    "mebli-city": "mebli-city.com.ua",
+    "fayni-mebli": "fayni-mebli.com",
+}
+# Ціна, записана в кожній збереженій сторінці; її замінюємо на ціну продукту
+FIXTURE_PRICES = {
+    "pufetto": "26 100",
+    "mebli-city": "31 600",
+    "fayni-mebli": "13 059",
+}
+
+
+def load_fixtures():
+    """Повертаємо словник сайт -> вміст збереженої сторінки (str)."""
+    return {site: (FIXTURES_DIR / f"{site}.html").read_text(encoding="utf-8") for site in SITE_HOSTS}
+
+
+def product_price(product_id: int) -> str:
+    """Детермінована ціна продукту у форматі сайтів, наприклад "12 300"."""
+    return f"{10000 + (product_id % 500) * 100:,}".replace(",", " ")
+
+
+def product_url(site: str, product_id: int, port: int) -> str:
+    """URL продукту на локальному сервері під доменом сайту."""
+    return f"http://{SITE_HOSTS[site]}:{port}/product/{product_id}"
+
+
+class LocalResolver(AbstractResolver):
+    """Резолвер aiohttp, який спрямовує будь-який домен на 127.0.0.1."""
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [{
+            "hostname": host,
+            "host": "127.0.0.1",
+            "port": port,
+            "family": socket.AF_INET,
+            "proto": 0,
+            "flags": socket.AI_NUMERICHOST,
+        }]
+
+    async def close(self):
+        pass
+
+
+class ShopServer:
+    """Сервер зі сторінками продуктів, налаштовуваною затримкою та частотою помилок."""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.fixtures = load_fixtures()
+        self.sites_by_host = {host: site for site, host in SITE_HOSTS.items()}
+        self.requests = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.port = None
+        self._runner = None
+
+    async def handle_product(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text="Service Unavailable")
+
+        site = self.sites_by_host.get(request.host.split(":")[0].removeprefix("www."))
+        if site is None:
+            return web.Response(status=404, text="Unknown site")
+        product_id = int(request.match_info["product_id"])
+        price = product_price(product_id)
+        etag = f'"{site}-{product_id}-{price.replace(" ", "")}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+
+        # Ціна у тексті сторінки ("13 059") та у структурованих даних ("13059")
+        body = (self.fixtures[site]
+                .replace(FIXTURE_PRICES[site], price)
+                .replace(FIXTURE_PRICES[site].replace(" ", ""), price.replace(" ", "")))
+        return web.Response(text=body, content_type="text/html", headers={"ETag": etag})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Запускаємо сервер; повертаємо номер порту (port=0 — будь-який вільний)."""
+        app = web.Application()
+        app.router.add_get("/product/{product_id}", self.handle_product)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def _serve_forever(args):
+    server = ShopServer(latency=args.latency, error_rate=args.error_rate)
+    port = await server.start(args.host, args.port)
+    print(f"Сервер магазинів слухає порт {port}. Приклад: {product_url('pufetto', 1, port)}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальний сервер сторінок магазинів для бенчмарків")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="середня затримка відповіді, секунд")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="частка відповідей 503 (0..1)")
+    asyncio.run(_serve_forever(parser.parse_args()))
@@ -1,204 +1,1517 @@
 import asyncio
+import bisect
+import csv
+import hashlib
+import heapq
+import html
+import itertools
+import json
+import math
+import os
+import random
 import ssl
 import re
+import signal
+import socket
 import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from importlib.util import find_spec
 from urllib.request import urlopen
-from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo  # Потрібен Python 3.9 або новіше
 
+import aiohttp
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 import logging
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+import soupsieve
 
 # -------------------- Налаштування -------------------- #
-BOT_TOKEN = "TOKEN"  # Вкажіть тут свій справжній токен бота
-DB_PATH = "products.db"  # Ім'я файлу бази даних
+# Вкажіть тут свій справжній токен бота (або задайте змінну середовища BOT_TOKEN)
+BOT_TOKEN = os.getenv("BOT_TOKEN", "TOKEN")
+DB_PATH = os.getenv("DB_PATH", "products.db")  # Ім'я файлу бази даних
 
 # Якщо TESTING=True, для тестування оновлення надсилатимуться кожну хвилину;
 # Якщо TESTING=False, оновлення будуть надсилатися щодня у встановлений час.
 TESTING = False
 
+# Скільки секунд результат скрейпінгу URL вважається свіжим і повторно
+# використовується для всіх користувачів, які відстежують цей самий продукт.
+SCRAPE_CACHE_TTL = 300
+
+# Максимальна кількість одночасних HTTP-запитів до всіх сайтів разом
+FETCH_GLOBAL_LIMIT = 20
+# Максимальна кількість одночасних запитів до кожного окремого сайту
+FETCH_HOST_LIMITS = {
+    "pufetto.com.ua": 4,
+    "mebli-city.com.ua": 4,
+    "fayni-mebli.com": 4,
+}
+# Ліміт для сайтів, яких немає у FETCH_HOST_LIMITS
+FETCH_DEFAULT_HOST_LIMIT = 2
+# Тайм-аути запитів до сайтів, секунд: на встановлення з'єднання,
+# на очікування чергової порції відповіді та на весь запит разом
+FETCH_CONNECT_TIMEOUT = 5
+FETCH_READ_TIMEOUT = 15
+FETCH_TOTAL_TIMEOUT = 30
+# Скільки разів повторюємо запит після тимчасової помилки
+# (збій з'єднання, тайм-аут, відповідь 429 або 5xx)
+FETCH_RETRIES = 2
+# Затримка перед повтором: випадкова, до FETCH_RETRY_BASE_DELAY × 2^спроба,
+# але не більше FETCH_RETRY_MAX_DELAY секунд
+FETCH_RETRY_BASE_DELAY = 0.5
+FETCH_RETRY_MAX_DELAY = 10
+# Після стількох невдалих запитів поспіль до сайту запобіжник розмикається:
+# протягом CIRCUIT_COOLDOWN секунд запити до сайту одразу завершуються помилкою,
+# а потім один пробний запит перевіряє, чи сайт відновився
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 60
+
+# Скільки байтів після кожного маркера "region" з SCRAPING_CONFIG входить у хеш
+# фрагмента сторінки. Якщо хеш не змінився, повторно сторінку не розбираємо.
+REGION_HASH_WINDOW = 4096
+# Навіть якщо сторінка не змінилася, раз на стільки секунд розбираємо її повністю
+PAGE_REPARSE_MAX_AGE = 24 * 60 * 60
+
+# Швидкий розбір сторінок звіряємо з повним розбором через html.parser
+# кожного разу на стільки сторінок кожного сайту. При розбіжності швидкий
+# розбір для цього сайту вимикається.
+EXTRACTION_PARITY_CHECK_EVERY = 100
+
+# Кількість процесів для розбору HTML. Розбір — це робота процесора на чистому
+# Python, тож в окремих процесах він не блокує цикл подій бота (0 — пул потоків).
+PARSE_PROCESSES = int(os.getenv("PARSE_PROCESSES", "2"))
+# Скільки сторінок на кожен процес може чекати розбору; далі скрейпінг чекає
+PARSE_QUEUE_PER_PROCESS = 4
+
+# Кількість потоків (і постійних з'єднань SQLite) для запитів до бази даних
+DB_POOL_SIZE = 4
+# Оновлення продуктів під час розсилки записуємо пакетами такого розміру
+DB_BATCH_SIZE = 200
+# Накопичені оновлення записуємо щонайменше раз на стільки секунд
+DB_FLUSH_INTERVAL = 2.0
+
+# Скільки користувачів планувальник обслуговує одночасно
+SCHEDULER_CONCURRENCY = 20
+# Скільки пропущених хвилин планувальник надолужує після затримки
+SCHEDULER_MAX_CATCHUP_MINUTES = 30
+# Фонові завдання (розсилку, попередній скрейпінг, згортання історії) виконує лише
+# один екземпляр бота — той, що тримає оренду в таблиці background_leases.
+# Оренду планувальника продовжуємо щохвилини; якщо екземпляр зупинився,
+# через стільки секунд її перебирає інший і надолужує пропущені хвилини.
+SCHEDULER_LEASE_SECONDS = 90
+# Як часто екземпляри перевіряють, чи пора згортати історію цін, секунд
+COMPACTOR_CHECK_INTERVAL = 60 * 60
+
+# За скільки хвилин до доставки починаємо заздалегідь скрейпити продукти користувачів.
+# Завантаження для кожної хвилини доставки рівномірно розподіляється на цей проміжок.
+PREFETCH_AHEAD_MINUTES = 10
+# Дані, старші за стільки секунд на момент доставки, отримуємо заново
+PREFETCH_MAX_AGE = 30 * 60
+
+# Як часто повторно завантажуємо сторінку продукту, залежить від того, як давно
+# змінювалася його ціна: інтервал дорівнює REFRESH_BACKOFF_FACTOR × час без змін,
+# але не менше REFRESH_MIN_INTERVAL і не більше REFRESH_MAX_INTERVAL секунд.
+# Продукти зі свіжою зміною ціни (акції, розпродажі) перевіряємо найчастіше.
+REFRESH_MIN_INTERVAL = 60 * 60
+REFRESH_MAX_INTERVAL = 7 * 24 * 60 * 60
+REFRESH_BACKOFF_FACTOR = 0.25
+# Скільки разів на годину планові оновлення можуть повторно завантажувати
+# сторінки кожного сайту. Продукти понад бюджет показуємо з останніми збереженими
+# даними. Нові продукти та команди користувачів бюджет не обмежує.
+REFRESH_SITE_BUDGETS = {
+    "pufetto.com.ua": 600,
+    "mebli-city.com.ua": 600,
+    "fayni-mebli.com": 600,
+}
+# Бюджет для сайтів, яких немає у REFRESH_SITE_BUDGETS
+REFRESH_DEFAULT_SITE_BUDGET = 300
+
+# Якщо EXTERNAL_SCRAPE_WORKERS=1, попередній скрейпінг виконують окремі процеси
+# (python bot.py worker), а процес бота лише ставить URL у чергу scrape_leases
+EXTERNAL_SCRAPE_WORKERS = os.getenv("EXTERNAL_SCRAPE_WORKERS") == "1"
+# Скільки URL воркер бере з черги за раз
+WORKER_BATCH_SIZE = 20
+# На скільки секунд воркер орендує взяті URL; після цього їх може забрати інший воркер
+WORKER_LEASE_SECONDS = 120
+# Як часто воркер перевіряє чергу, коли вона порожня, секунд
+WORKER_POLL_INTERVAL = 2
+# Через скільки секунд повторюємо URL, скрейпінг якого не вдався; після кожної
+# наступної невдачі затримка подвоюється
+WORKER_RETRY_DELAY = 300
+# Після стількох невдалих спроб поспіль прибираємо URL з черги (наприклад, товар
+# зняли з продажу і сторінка віддає 404); наступного разу його поставить у чергу
+# попередній скрейпінг, з урахуванням бюджету сайту
+WORKER_MAX_ATTEMPTS = 4
+
+# Скільки днів зберігаємо кожну зміну ціни окремо; старіші точки історії
+# згортаємо в денні підсумки (мінімум, максимум, остання ціна за день)
+HISTORY_RAW_DAYS = 30
+# Скільки останніх змін ціни показує команда /history
+HISTORY_SHOW_POINTS = 15
+
+# Ліміти Telegram: скільки повідомлень на секунду можна надсилати загалом
+# і в один чат, та скільки повідомлень у чат можна надіслати поспіль
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+# Максимальна довжина одного повідомлення Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Кількість паралельних обробників черги вихідних повідомлень
+OUTBOX_WORKERS = 8
+
+# Скільки списків продуктів користувачів тримаємо в пам'яті (давно не використані
+# витісняються) і скільки секунд список вважається актуальним. Термін потрібен,
+# якщо кілька екземплярів бота працюють зі спільною базою: зміни, зроблені
+# іншим екземпляром, стануть видимими щонайпізніше через стільки секунд.
+USER_PRODUCTS_CACHE_SIZE = 10000
+USER_PRODUCTS_CACHE_TTL = 300
+
+# Скільки продуктів команда /check перевіряє одночасно
+CHECK_CONCURRENCY = 8
+# Не частіше ніж раз на стільки секунд /check редагує повідомлення з прогресом
+CHECK_EDIT_INTERVAL = 3
+# Скільки посилань можна імпортувати однією командою /import, скільки з них
+# скрейпимо одночасно, та максимальний розмір файлу зі списком посилань (байтів)
+IMPORT_MAX_URLS = 200
+IMPORT_CONCURRENCY = 8
+IMPORT_MAX_FILE_SIZE = 1024 * 1024
+# Режими правил сповіщень (таблиця notification_rules, команда /notify)
+NOTIFY_DIGEST = "digest"
+NOTIFY_CHANGE = "change"
+NOTIFY_DROP_PERCENT = "drop_percent"
+NOTIFY_DROP_AMOUNT = "drop_amount"
+
+# Локальний HTTP-сервер з метриками у форматі Prometheus; за замовчуванням вимкнений.
+# Кожному екземпляру бота на одній машині потрібен свій порт (наприклад, METRICS_PORT=9100)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Telegram ID адміністраторів, яким доступна команда /stats (через кому)
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+
+# Як бот отримує оновлення від Telegram: "polling" (довге опитування) або "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Webhook: локальна адреса та шлях HTTP-сервера, який приймає оновлення
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Публічна адреса (https://...), за якою Telegram бачить сервер; до неї додається WEBHOOK_PATH.
+# Якщо порожня, бот не реєструє webhook сам (наприклад, це робить інший екземпляр).
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")
+# Секрет, який Telegram надсилає в заголовку X-Telegram-Bot-Api-Secret-Token; обов'язковий
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Скільки одночасних з'єднань Telegram відкриває до webhook (1–100)
+WEBHOOK_MAX_CONNECTIONS = 40
+# Скільки оновлень бот обробляє одночасно; наступні чекають, доки звільниться місце
+MAX_UPDATES_IN_FLIGHT = 50
+# Скільки секунд під час зупинки чекаємо завершення оновлень, що вже обробляються
+SHUTDOWN_GRACE_SECONDS = 10
+# Адреса власного сервера Bot API (наприклад, локального telegram-bot-api);
+# порожня — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+)
 dp = Dispatcher()
 
+# -------------------- Метрики -------------------- #
+# Прості лічильники та гістограми в пам'яті процесу. Запис метрики — це лише
+# кілька операцій зі словником, тож їх можна не вимикати в робочому режимі.
+# Значення віддаються у форматі Prometheus (/metrics) і командою /stats.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []
+
+class Counter:
+    """Лічильник, що лише зростає; окреме значення для кожного набору міток."""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+class Gauge:
+    """Поточне значення; задається вручну або обчислюється функцією callback."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback=None):
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.values = {}
+        _metrics.append(self)
+
+    def set(self, value: float, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.callback is not None:
+            yield self.name, (), self.callback()
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+class Histogram:
+    """Гістограма тривалостей (у секундах) з фіксованими межами кошиків."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # мітки -> [кількість у кожному кошику (останній — +Inf), сума, кількість]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (bucket_counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", key + (("le", le),), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+def render_metrics() -> str:
+    """Повертаємо всі метрики в текстовому форматі Prometheus."""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                label_text = ",".join(f'{key}="{value_}"' for key, value_ in labels)
+                lines.append(f"{name}{{{label_text}}} {value}")
+            else:
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+def histogram_summary(histogram: Histogram):
+    """Повертаємо {мітки: (кількість, середнє, верхня межа p95)} для команди /stats."""
+    summary = {}
+    for key, (bucket_counts, total, count) in histogram.values.items():
+        if not count:
+            continue
+        cumulative = 0
+        p95 = float("inf")
+        for bound, bucket_count in zip(histogram.buckets + (float("inf"),), bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= count * 0.95:
+                p95 = bound
+                break
+        summary[key] = (count, total / count, p95)
+    return summary
+
+async def handle_metrics_request(request: web.Request) -> web.Response:
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    """Запускаємо локальний HTTP-сервер з /metrics; повертаємо його runner або None."""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics_request)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # Порт зайнятий (наприклад, іншим екземпляром бота): працюємо без метрик
+        logging.warning(f"Не вдалося запустити сервер метрик на {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Метрики доступні на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+FETCH_SECONDS = Histogram("pandyvan_fetch_seconds", "Тривалість завантаження сторінки")
+PARSE_SECONDS = Histogram("pandyvan_parse_seconds", "Тривалість розбору HTML сторінки")
+SCRAPE_RESULTS = Counter("pandyvan_scrape_results_total", "Результати скрейпінгу за сайтами")
+DB_SECONDS = Histogram("pandyvan_db_seconds", "Тривалість виконання функцій роботи з базою")
+SEND_SECONDS = Histogram("pandyvan_telegram_send_seconds", "Тривалість надсилання повідомлення Telegram")
+SEND_RESULTS = Counter("pandyvan_telegram_send_total", "Результати надсилання повідомлень Telegram")
+BUCKET_SECONDS = Histogram("pandyvan_scheduler_bucket_seconds", "Тривалість розсилки однієї хвилини доставки")
+SCHEDULER_LAG = Gauge("pandyvan_scheduler_lag_seconds", "Запізнення пробудження планувальника від початку хвилини")
+FETCH_RETRY_COUNT = Counter("pandyvan_fetch_retries_total", "Повторні запити до сайтів після тимчасових помилок")
+CIRCUIT_REJECTED = Counter("pandyvan_circuit_rejected_total", "Запити, відхилені розімкненим запобіжником сайту")
+CIRCUIT_STATE = Gauge("pandyvan_circuit_state", "Стан запобіжника сайту: 0 — замкнений, 1 — пробний, 2 — розімкнений")
+USER_PRODUCTS_CACHE_RESULTS = Counter("pandyvan_user_products_cache_total", "Звернення до кешу списків продуктів")
+NOTIFICATIONS = Counter("pandyvan_notifications_total", "Продукти в щоденних розсилках: надіслані та відфільтровані")
+REFRESH_DECISIONS = Counter("pandyvan_refresh_decisions_total", "Рішення про повторне завантаження продуктів за сайтами")
+Gauge("pandyvan_outbox_queue_depth", "Повідомлень у черзі на надсилання",
+      lambda: outbox_size())
+Gauge("pandyvan_scrapes_in_flight", "Скрейпінгів, що виконуються зараз", lambda: len(_scrape_inflight))
+Gauge("pandyvan_pending_product_updates", "Оновлень продуктів, що очікують запису в базу",
+      lambda: len(_pending_product_updates))
+Gauge("pandyvan_background_tasks", "Активних фонових завдань", lambda: len(_background_tasks))
+Gauge("pandyvan_updates_in_flight", "Оновлень Telegram, що обробляються зараз", lambda: _updates_in_flight)
+Gauge("pandyvan_parse_pending", "Сторінок, що чекають або проходять розбір", lambda: _parse_pending)
+
 # -------------------- Функції для роботи з базою даних -------------------- #
+# Кожен потік пулу DB_POOL_SIZE тримає власне постійне з'єднання з SQLite.
+# Усі запити виконуються в цьому пулі через run_db, тому не блокують цикл подій.
+_db_local = threading.local()
+_db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+# Міграції схеми: елемент з індексом i переводить базу до версії i + 1.
+# Поточна версія зберігається в PRAGMA user_version.
+MIGRATIONS = [
+    # 1. Початкова схема: продукти, налаштування користувачів, кеш сторінок
+    '''
+    CREATE TABLE IF NOT EXISTS tracked_products (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        url TEXT,
+        title TEXT,
+        price TEXT,
+        last_scrape TEXT
+    );
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id INTEGER PRIMARY KEY,
+        update_time TEXT
+    );
+    CREATE TABLE IF NOT EXISTS page_cache (
+        url TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        content_hash TEXT,
+        title TEXT,
+        price_text TEXT,
+        fetched_at REAL,
+        parsed_at REAL
+    );
+    ''',
+    # 2. Індекси для пошуку продуктів за користувачем та URL
+    '''
+    CREATE INDEX IF NOT EXISTS idx_tracked_products_user_url ON tracked_products (user_id, url);
+    CREATE INDEX IF NOT EXISTS idx_tracked_products_url ON tracked_products (url);
+    CREATE INDEX IF NOT EXISTS idx_user_settings_update_time ON user_settings (update_time);
+    ''',
+    # 3. Числова ціна продукту та спільна для всіх користувачів історія цін за URL
+    '''
+    ALTER TABLE tracked_products ADD COLUMN price_value REAL;
+    UPDATE tracked_products SET price_value = parse_price(price) WHERE price IS NOT NULL;
+    CREATE TABLE IF NOT EXISTS price_history (
+        url TEXT NOT NULL,
+        recorded_at REAL NOT NULL,
+        price REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_price_history_url_time ON price_history (url, recorded_at);
+    CREATE TABLE IF NOT EXISTS price_rollups (
+        url TEXT NOT NULL,
+        day TEXT NOT NULL,
+        min_price REAL NOT NULL,
+        max_price REAL NOT NULL,
+        last_price REAL NOT NULL,
+        PRIMARY KEY (url, day)
+    ) WITHOUT ROWID;
+    ''',
+    # 4. Черга URL для окремих процесів-воркерів скрейпінгу з орендою записів
+    '''
+    CREATE TABLE IF NOT EXISTS scrape_leases (
+        url TEXT PRIMARY KEY,
+        due_at REAL NOT NULL,
+        lease_owner TEXT,
+        lease_until REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_scrape_leases_due ON scrape_leases (due_at);
+    ''',
+    # 5. Коли ціна продукту востаннє змінювалася і коли його пора завантажити знову
+    '''
+    ALTER TABLE page_cache ADD COLUMN changed_at REAL;
+    ALTER TABLE page_cache ADD COLUMN next_check_at REAL;
+    UPDATE page_cache SET changed_at = COALESCE(
+        (SELECT MAX(recorded_at) FROM price_history WHERE price_history.url = page_cache.url),
+        parsed_at
+    );
+    ''',
+    # 6. Правила сповіщень користувачів і ціна, про яку користувача востаннє сповіщено
+    '''
+    ALTER TABLE tracked_products ADD COLUMN notified_price REAL;
+    UPDATE tracked_products SET notified_price = price_value;
+    CREATE TABLE IF NOT EXISTS notification_rules (
+        user_id INTEGER PRIMARY KEY,
+        mode TEXT NOT NULL,
+        threshold REAL
+    );
+    ''',
+    # 7. Оренда фонових завдань: їх виконує лише один екземпляр бота
+    '''
+    CREATE TABLE IF NOT EXISTS background_leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        lease_until REAL NOT NULL,
+        progress REAL
+    );
+    ''',
+    # 8. Кількість невдалих спроб скрейпінгу URL у черзі воркерів
+    '''
+    ALTER TABLE scrape_leases ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;
+    ''',
+]
+
+def get_db() -> sqlite3.Connection:
+    """Повертаємо постійне з'єднання з базою для поточного потоку, створюючи його за потреби."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        # WAL дозволяє читати паралельно із записом, а synchronous=NORMAL
+        # у режимі WAL робить fsync лише при контрольних точках
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")
+        conn.execute("PRAGMA foreign_keys=ON")
+        # Дозволяємо міграціям розбирати текст ціни так само, як це робить бот
+        conn.create_function("parse_price", 1, parse_price, deterministic=True)
+        _db_local.conn = conn
+    return conn
+
+def _timed_db_call(func, *args):
+    """Виконуємо функцію роботи з базою; повертаємо (результат, виняток або None, тривалість)."""
+    start = time.perf_counter()
+    try:
+        result = func(*args)
+    except Exception as e:
+        return None, e, time.perf_counter() - start
+    return result, None, time.perf_counter() - start
+
+async def run_db(func, *args):
+    """
+    Виконуємо синхронну функцію роботи з базою в пулі потоків бази даних.
+    Тривалість записуємо в метрики вже в циклі подій: метрики не захищені
+    від одночасних змін з кількох потоків.
+    """
+    loop = asyncio.get_running_loop()
+    result, error, elapsed = await loop.run_in_executor(_db_executor, _timed_db_call, func, *args)
+    DB_SECONDS.observe(elapsed, helper=func.__name__)
+    if error is not None:
+        raise error
+    return result
+
 def init_db():
     """
-    Створюємо таблиці для відстежуваних продуктів та налаштувань користувачів,
-    якщо вони ще не існують. Це нам потрібно для збереження даних.
-    """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    # Таблиця для збереження інформації про продукти, які ви відстежуєте
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS tracked_products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            url TEXT,
-            title TEXT,
-            price TEXT,
-            last_scrape TEXT
-        )
-    ''')
-    # Таблиця для збереження часу оновлення, який встановлює користувач
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS user_settings (
-            user_id INTEGER PRIMARY KEY,
-            update_time TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    Застосовуємо до бази всі міграції, які ще не були застосовані.
+    Викликається один раз під час запуску бота.
+    """
+    conn = get_db()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, script in enumerate(MIGRATIONS[version:], start=version + 1):
+        logging.info(f"Застосовуємо міграцію бази даних №{number}.")
+        conn.executescript(f"BEGIN; {script} PRAGMA user_version = {number}; COMMIT;")
 
-def add_tracked_product(user_id: int, url: str, title: str, price: str, timestamp: str):
+def add_tracked_product(user_id: int, url: str, title: str, price: float, timestamp: str):
     """Додаємо новий запис про відстежуваний продукт у базу даних."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO tracked_products (user_id, url, title, price, last_scrape)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, url, title, price, timestamp))
-    conn.commit()
-    conn.close()
-
-def update_tracked_product(product_id: int, title: str, price: str, timestamp: str):
+    with get_db() as conn:
+        conn.execute("""
+            INSERT INTO tracked_products (user_id, url, title, price, price_value, last_scrape, notified_price)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, url, title, str(price), price, timestamp, price))
+
+def add_tracked_products(user_id: int, rows) -> int:
+    """
+    Додаємо кілька продуктів користувача однією транзакцією.
+    rows — список кортежів (url, title, price, timestamp), де price — число.
+    URL, які користувач уже відстежує, пропускаємо. Повертаємо кількість доданих записів.
+    """
+    with get_db() as conn:
+        c = conn.executemany("""
+            INSERT INTO tracked_products (user_id, url, title, price, price_value, last_scrape, notified_price)
+            SELECT ?, ?, ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM tracked_products WHERE user_id = ? AND url = ?)
+        """, [(user_id, url, title, str(price), price, timestamp, price, user_id, url)
+              for url, title, price, timestamp in rows])
+    return c.rowcount
+
+def update_tracked_product(product_id: int, title: str, price: float, timestamp: str):
     """Оновлюємо інформацію про відстежуваний продукт у базі даних."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        UPDATE tracked_products
-        SET title = ?, price = ?, last_scrape = ?
-        WHERE id = ?
-    """, (title, price, timestamp, product_id))
-    conn.commit()
-    conn.close()
+    update_tracked_products([(product_id, title, price, timestamp)])
+
+def update_tracked_products(updates, notified_prices=()):
+    """
+    Оновлюємо кілька продуктів однією транзакцією.
+    updates — список кортежів (product_id, title, price, timestamp), де price — число.
+    notified_prices — список кортежів (product_id, notified_price) для правил сповіщень.
+    notified_price змінюємо лише через notified_prices: /check оновлює ціну продукту,
+    але не базову ціну сповіщень, тож зміну від неї побачить щоденне оновлення.
+    """
+    with get_db() as conn:
+        conn.executemany("""
+            UPDATE tracked_products
+            SET title = ?, price = ?, price_value = ?, last_scrape = ?
+            WHERE id = ?
+        """, [(title, str(price), price, timestamp, product_id)
+              for product_id, title, price, timestamp in updates])
+        conn.executemany("UPDATE tracked_products SET notified_price = ? WHERE id = ?",
+                         [(notified_price, product_id) for product_id, notified_price in notified_prices])
 
 def delete_tracked_product(user_id: int, url: str) -> bool:
     """
     Видаляємо запис про продукт для конкретного користувача за URL.
     Повертаємо True, якщо запис успішно видалено.
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM tracked_products WHERE user_id = ? AND url = ?", (user_id, url))
-    conn.commit()
-    changes = c.rowcount
-    conn.close()
-    return changes > 0
+    with get_db() as conn:
+        c = conn.execute("DELETE FROM tracked_products WHERE user_id = ? AND url = ?", (user_id, url))
+    return c.rowcount > 0
 
 def get_all_tracked_products():
     """Повертаємо всі записи про відстежувані продукти з бази."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, user_id, url, title, price, last_scrape FROM tracked_products")
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return get_db().execute("SELECT id, user_id, url, title, price, last_scrape FROM tracked_products").fetchall()
 
-def get_tracked_product(user_id: int, url: str):
+def get_products_for_user(user_id: int):
     """
-    Повертаємо запис про продукт для заданого користувача та URL,
-    або повертаємо None, якщо такий запис не знайдено.
+    Повертаємо всі продукти, які відстежує конкретний користувач,
+    як кортежі (id, url, title, ціна числом, last_scrape, ціна з останнього сповіщення).
     """
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, title, price, last_scrape FROM tracked_products WHERE user_id = ? AND url = ?", (user_id, url))
-    product = c.fetchone()
-    conn.close()
-    return product
-
-def get_products_for_user(user_id: int):
-    """Повертаємо всі продукти, які відстежує конкретний користувач."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, url, title, price, last_scrape FROM tracked_products WHERE user_id = ?", (user_id,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return get_db().execute(
+        "SELECT id, url, title, price_value, last_scrape, notified_price FROM tracked_products WHERE user_id = ?",
+        (user_id,),
+    ).fetchall()
 
 # Функції для роботи з налаштуваннями користувачів
 def set_user_update_time(user_id: int, update_time: str):
     """Встановлюємо або оновлюємо бажаний час оновлення для користувача (у форматі HH:MM)."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO user_settings (user_id, update_time) VALUES (?, ?)", (user_id, update_time))
-    conn.commit()
-    conn.close()
+    with get_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO user_settings (user_id, update_time) VALUES (?, ?)",
+                     (user_id, update_time))
 
 def get_all_user_settings():
     """Повертаємо всі налаштування користувачів як список кортежів (user_id, update_time)."""
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT user_id, update_time FROM user_settings")
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    return get_db().execute("SELECT user_id, update_time FROM user_settings").fetchall()
+
+def get_users_for_update_time(update_time: str):
+    """Повертаємо ID користувачів, чий час оновлень — update_time (HH:MM)."""
+    return [user_id for (user_id,) in get_db().execute(
+        "SELECT user_id FROM user_settings WHERE update_time = ?", (update_time,))]
+
+def get_notification_rule(user_id: int):
+    """Повертаємо правило сповіщень користувача як кортеж (mode, threshold); за замовчуванням — щоденний звіт."""
+    row = get_db().execute("SELECT mode, threshold FROM notification_rules WHERE user_id = ?", (user_id,)).fetchone()
+    return row if row is not None else (NOTIFY_DIGEST, None)
+
+def set_notification_rule(user_id: int, mode: str, threshold):
+    """
+    Зберігаємо правило сповіщень користувача. Зниження ціни відтепер
+    рахуємо від поточних цін його продуктів.
+    """
+    with get_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO notification_rules (user_id, mode, threshold) VALUES (?, ?, ?)",
+                     (user_id, mode, threshold))
+        conn.execute("UPDATE tracked_products SET notified_price = price_value WHERE user_id = ?", (user_id,))
+
+# Функції для роботи з кешем сторінок
+def get_page_cache(url: str):
+    """
+    Повертаємо збережений стан сторінки як кортеж
+    (etag, last_modified, content_hash, title, price_text, fetched_at, parsed_at, changed_at)
+    або None, якщо сторінку ще не завантажували.
+    """
+    return get_db().execute("""
+        SELECT etag, last_modified, content_hash, title, price_text, fetched_at, parsed_at, changed_at
+        FROM page_cache WHERE url = ?
+    """, (url,)).fetchone()
+
+def save_page_cache(url: str, etag, last_modified, content_hash, title: str, price_text: str,
+                    fetched_at: float, parsed_at: float, changed_at: float, next_check_at: float):
+    """Зберігаємо або оновлюємо стан сторінки після завантаження."""
+    with get_db() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO page_cache
+                (url, etag, last_modified, content_hash, title, price_text, fetched_at, parsed_at,
+                 changed_at, next_check_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (url, etag, last_modified, content_hash, title, price_text, fetched_at, parsed_at,
+              changed_at, next_check_at))
+
+def get_cached_results(urls):
+    """
+    Повертаємо збережені результати скрейпінгу для списку URL
+    як словник url -> (title, price_text, fetched_at, next_check_at).
+    """
+    conn = get_db()
+    results = {}
+    urls = list(urls)
+    # SQLite обмежує кількість параметрів запиту, тому ділимо список на частини
+    for start in range(0, len(urls), 500):
+        chunk = urls[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        for url, title, price_text, fetched_at, next_check_at in conn.execute(
+            f"SELECT url, title, price_text, fetched_at, next_check_at FROM page_cache "
+            f"WHERE url IN ({placeholders})", chunk
+        ):
+            results[url] = (title, price_text, fetched_at, next_check_at)
+    return results
+
+def get_urls_for_users(user_ids):
+    """Повертаємо список унікальних URL, які відстежують задані користувачі."""
+    conn = get_db()
+    urls = set()
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        urls.update(url for (url,) in conn.execute(
+            f"SELECT DISTINCT url FROM tracked_products WHERE user_id IN ({placeholders})", chunk
+        ))
+    return list(urls)
+
+# Функції для роботи з чергою воркерів скрейпінгу
+def enqueue_scrapes(items):
+    """
+    Ставимо URL у чергу воркерів. items — список кортежів (url, due_at).
+    Якщо URL уже в черзі, залишаємо найранішій час.
+    """
+    with get_db() as conn:
+        conn.executemany("""
+            INSERT INTO scrape_leases (url, due_at) VALUES (?, ?)
+            ON CONFLICT (url) DO UPDATE SET due_at = MIN(due_at, excluded.due_at)
+        """, items)
+
+def claim_scrape_batch(owner: str, limit: int, now: float):
+    """
+    Орендуємо до limit URL, час яких настав і які ніхто не орендує
+    (або оренда яких прострочена, бо воркер завершився аварійно).
+    Повертаємо список URL.
+    """
+    conn = get_db()
+    # BEGIN IMMEDIATE одразу бере блокування на запис, тож два воркери
+    # не можуть орендувати той самий URL
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        urls = [url for (url,) in conn.execute("""
+            SELECT url FROM scrape_leases
+            WHERE due_at <= ? AND (lease_until IS NULL OR lease_until < ?)
+            ORDER BY due_at LIMIT ?
+        """, (now, now, limit))]
+        conn.executemany("UPDATE scrape_leases SET lease_owner = ?, lease_until = ? WHERE url = ?",
+                         [(owner, now + WORKER_LEASE_SECONDS, url) for url in urls])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return urls
+
+def finish_scrape_leases(owner: str, done_urls, failed_urls, now: float) -> int:
+    """
+    Звільняємо оренду: успішно оброблені URL видаляємо з черги, а невдалі
+    повертаємо в чергу із затримкою WORKER_RETRY_DELAY, що подвоюється з кожною
+    спробою. URL, які не вдалося обробити WORKER_MAX_ATTEMPTS разів, видаляємо.
+    Повертаємо кількість видалених через невдачі URL.
+    """
+    with get_db() as conn:
+        conn.executemany("DELETE FROM scrape_leases WHERE url = ? AND lease_owner = ?",
+                         [(url, owner) for url in done_urls])
+        dropped = conn.executemany("""
+            DELETE FROM scrape_leases WHERE url = ? AND lease_owner = ? AND attempts + 1 >= ?
+        """, [(url, owner, WORKER_MAX_ATTEMPTS) for url in failed_urls]).rowcount
+        conn.executemany("""
+            UPDATE scrape_leases
+            SET lease_owner = NULL, lease_until = NULL, attempts = attempts + 1,
+                due_at = ? + ? * (1 << attempts)
+            WHERE url = ? AND lease_owner = ?
+        """, [(now, WORKER_RETRY_DELAY, url, owner) for url in failed_urls])
+    return dropped
+
+# Функції для роботи з орендою фонових завдань
+def acquire_background_lease(name: str, owner: str, now: float, seconds: float):
+    """
+    Беремо або продовжуємо оренду фонового завдання name на seconds секунд.
+    Оренду, яку тримає інший екземпляр і строк якої не минув, не чіпаємо.
+    Повертаємо (чи тримаємо оренду, збережений прогрес завдання).
+    """
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT owner, lease_until, progress FROM background_leases WHERE name = ?",
+                           (name,)).fetchone()
+        if row is not None and row[0] != owner and row[1] >= now:
+            conn.rollback()
+            return False, None
+        conn.execute("""
+            INSERT INTO background_leases (name, owner, lease_until) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until
+        """, (name, owner, now + seconds))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True, row[2] if row is not None else None
+
+def set_background_lease_progress(name: str, owner: str, progress: float):
+    """Зберігаємо прогрес фонового завдання, якщо його оренда досі наша."""
+    with get_db() as conn:
+        conn.execute("UPDATE background_leases SET progress = ? WHERE name = ? AND owner = ?",
+                     (progress, name, owner))
+
+# Функції для роботи з історією цін
+def record_price_point(url: str, price: float, recorded_at: float) -> bool:
+    """
+    Записуємо ціну в історію, лише якщо вона відрізняється від останньої записаної.
+    Порівнюємо з базою в тому ж INSERT, тож кілька процесів, що пишуть в одну базу,
+    не дублюють точки. Повертаємо True, якщо точку додано.
+    """
+    with get_db() as conn:
+        cursor = conn.execute("""
+            INSERT INTO price_history (url, recorded_at, price)
+            SELECT ?, ?, ?
+            WHERE COALESCE(
+                (SELECT price FROM price_history WHERE url = ? ORDER BY recorded_at DESC LIMIT 1),
+                (SELECT last_price FROM price_rollups WHERE url = ? ORDER BY day DESC LIMIT 1)
+            ) IS NOT ?
+        """, (url, recorded_at, price, url, url, price))
+    return cursor.rowcount > 0
+
+def compact_price_history(before: float):
+    """
+    Згортаємо точки історії, старіші за before (початок доби UTC, unix-час),
+    у денні підсумки таблиці price_rollups і видаляємо їх із price_history.
+    """
+    with get_db() as conn:
+        conn.execute("""
+            INSERT INTO price_rollups (url, day, min_price, max_price, last_price)
+            SELECT url, date(recorded_at, 'unixepoch') AS day, MIN(price), MAX(price),
+                   (SELECT h2.price FROM price_history h2
+                    WHERE h2.url = h.url
+                      AND date(h2.recorded_at, 'unixepoch') = date(h.recorded_at, 'unixepoch')
+                      AND h2.recorded_at < ?
+                    ORDER BY h2.recorded_at DESC LIMIT 1)
+            FROM price_history h
+            WHERE recorded_at < ?
+            GROUP BY url, day
+            ON CONFLICT (url, day) DO UPDATE SET
+                min_price = MIN(min_price, excluded.min_price),
+                max_price = MAX(max_price, excluded.max_price),
+                last_price = excluded.last_price
+        """, (before, before))
+        conn.execute("DELETE FROM price_history WHERE recorded_at < ?", (before,))
+
+def get_price_history(url: str, limit: int):
+    """
+    Повертаємо історію цін для URL як кортеж:
+    (мінімальна ціна, максимальна ціна, список останніх limit точок (дата, ціна) від старих до нових).
+    """
+    conn = get_db()
+    min_price, max_price = conn.execute("""
+        SELECT MIN(low), MAX(high) FROM (
+            SELECT MIN(price) AS low, MAX(price) AS high FROM price_history WHERE url = ?
+            UNION ALL
+            SELECT MIN(min_price), MAX(max_price) FROM price_rollups WHERE url = ?
+        )
+    """, (url, url)).fetchone()
+    points = conn.execute("""
+        SELECT * FROM (
+            SELECT datetime(recorded_at, 'unixepoch'), price
+            FROM price_history WHERE url = ?
+            ORDER BY price_history.recorded_at DESC LIMIT ?
+        )
+        UNION ALL
+        SELECT * FROM (
+            SELECT day, last_price FROM price_rollups WHERE url = ?
+            ORDER BY day DESC LIMIT ?
+        )
+        ORDER BY 1 DESC LIMIT ?
+    """, (url, limit, url, limit, limit)).fetchall()
+    return min_price, max_price, points[::-1]
 
-# Ініціалізуємо базу даних (якщо таблиці ще не створені, вони будуть створені)
-init_db()
+def write_export_csv(user_id: int, path: str) -> int:
+    """
+    Записуємо у CSV-файл path продукти користувача та історію їхніх цін.
+    Рядки читаємо з курсора й одразу пишемо у файл, тож весь експорт
+    ніколи не тримаємо в пам'яті. Повертаємо кількість продуктів.
+    Стовпець type: product — продукт, price — зміна ціни, daily — денний підсумок.
+    """
+    conn = get_db()
+    products = 0
+    # utf-8-sig, щоб Excel правильно показав кирилицю
+    with open(path, "w", newline="", encoding="utf-8-sig") as file:
+        writer = csv.writer(file)
+        writer.writerow(["type", "url", "title", "time", "price", "min_price", "max_price"])
+        for url, title, price, last_scrape in conn.execute(
+            "SELECT url, title, price_value, last_scrape FROM tracked_products WHERE user_id = ? ORDER BY id",
+            (user_id,),
+        ):
+            writer.writerow(["product", url, title, last_scrape, price, "", ""])
+            products += 1
+        for url, recorded_at, price in conn.execute("""
+            SELECT url, datetime(recorded_at, 'unixepoch'), price FROM price_history
+            WHERE url IN (SELECT url FROM tracked_products WHERE user_id = ?)
+            ORDER BY url, recorded_at
+        """, (user_id,)):
+            writer.writerow(["price", url, "", recorded_at, price, "", ""])
+        for url, day, last_price, min_price, max_price in conn.execute("""
+            SELECT url, day, last_price, min_price, max_price FROM price_rollups
+            WHERE url IN (SELECT url FROM tracked_products WHERE user_id = ?)
+            ORDER BY url, day
+        """, (user_id,)):
+            writer.writerow(["daily", url, "", day, last_price, min_price, max_price])
+    return products
+
+# -------------------- Кеш списків продуктів користувачів -------------------- #
+# Списки продуктів (результати get_products_for_user) тримаємо в пам'яті,
+# щоб /list, /check та розсилки не читали з бази ті самі незмінені дані.
+# Після кожної зміни продуктів користувача його список видаляємо з кешу.
+# user_id -> (час збереження за time.monotonic(), список продуктів); порядок — від давно використаних
+_user_products_cache = OrderedDict()
+# Зростає при кожному скиданні кешу; див. get_user_products
+_user_products_generation = 0
+
+async def get_user_products(user_id: int):
+    """Повертаємо продукти користувача (як get_products_for_user) з кешу або з бази."""
+    entry = _user_products_cache.get(user_id)
+    if entry is not None and time.monotonic() - entry[0] < USER_PRODUCTS_CACHE_TTL:
+        _user_products_cache.move_to_end(user_id)
+        USER_PRODUCTS_CACHE_RESULTS.inc(result="hit")
+        return entry[1]
+
+    USER_PRODUCTS_CACHE_RESULTS.inc(result="miss")
+    generation = _user_products_generation
+    products = await run_db(get_products_for_user, user_id)
+    # Якщо поки ми читали базу, кеш скидали, прочитаний список міг уже застаріти
+    if generation == _user_products_generation:
+        _user_products_cache[user_id] = (time.monotonic(), products)
+        _user_products_cache.move_to_end(user_id)
+        while len(_user_products_cache) > USER_PRODUCTS_CACHE_SIZE:
+            _user_products_cache.popitem(last=False)
+    return products
+
+def invalidate_user_products(*user_ids: int):
+    """Видаляємо з кешу списки продуктів користувачів, чиї продукти змінилися."""
+    global _user_products_generation
+    _user_products_generation += 1
+    for user_id in user_ids:
+        _user_products_cache.pop(user_id, None)
+
+# -------------------- Пакетний запис оновлень продуктів -------------------- #
+# Оновлення продуктів під час циклу розсилки не пишемо по одному, а накопичуємо
+# і записуємо пакетами через executemany в одній транзакції.
+# Елементи: (user_id, product_id, title, price, timestamp, notified_price)
+_pending_product_updates = []
+_product_flush_lock = None
+
+def queue_product_update(user_id: int, product_id: int, title: str, price: float, timestamp: str,
+                         notified_price: float = None):
+    """Додаємо оновлення продукту до черги пакетного запису."""
+    _pending_product_updates.append((user_id, product_id, title, price, timestamp, notified_price))
+    if len(_pending_product_updates) >= DB_BATCH_SIZE:
+        start_background_task(flush_product_updates())
+
+async def flush_product_updates():
+    """Записуємо всі накопичені оновлення продуктів однією транзакцією."""
+    global _product_flush_lock
+    if _product_flush_lock is None:
+        _product_flush_lock = asyncio.Lock()
+    async with _product_flush_lock:
+        if not _pending_product_updates:
+            return
+        batch = _pending_product_updates[:]
+        del _pending_product_updates[:]
+        updates = [(product_id, title, price, timestamp) for _, product_id, title, price, timestamp, _ in batch]
+        notified_prices = [(product_id, notified_price) for _, product_id, _, _, _, notified_price in batch
+                           if notified_price is not None]
+        try:
+            await run_db(update_tracked_products, updates, notified_prices)
+        except Exception as e:
+            logging.error(f"Не вдалося записати {len(batch)} оновлень продуктів: {e}")
+        invalidate_user_products(*{user_id for user_id, *_ in batch})
+
+async def product_update_flusher():
+    """Фонове завдання, яке кожні DB_FLUSH_INTERVAL секунд записує накопичені оновлення."""
+    while True:
+        await asyncio.sleep(DB_FLUSH_INTERVAL)
+        await flush_product_updates()
 
 # -------------------- Налаштування для скрейпінгу -------------------- #
 # Використовуємо CSS-селектори через BeautifulSoup для кожного сайту
 SCRAPING_CONFIG = {
     "pufetto": {
+        # Домен сайту (без www. та мобільних піддоменів)
+        "host": "pufetto.com.ua",
         "title": "#root > div:nth-child(4) > div > div.leftpart.mainleft > div.nm_bc > h1",
-        "price": "#slidepanel > div:nth-of-type(3) > b"
+        "price": "#slidepanel > div:nth-of-type(3) > b",
+        # Маркери фрагментів HTML, у яких знаходяться назва та ціна. Хешуємо лише
+        # REGION_HASH_WINDOW байтів після кожного маркера, тож маркер має стояти
+        # безпосередньо перед елементом з назвою чи ціною, а не на початку великого блоку
+        "region": ('class="nm_bc"', 'id="slidepanel"'),
+        # Чи є на сторінках структуровані дані (JSON-LD або мета-теги ціни);
+        # у pufetto їх немає, тож не шукаємо їх даремно (див. extract_structured)
+        "structured": False
     },
     "mebli-city": {
+        "host": "mebli-city.com.ua",
         "title": "#maincontent > div:nth-of-type(2) > div > div:nth-of-type(1) > div:nth-of-type(2) > div:nth-of-type(1) > div:nth-of-type(2) > h1 > span",
-        "price": "[id^='product-price-'] > span"
+        "price": "[id^='product-price-'] > span",
+        "region": ('class="page-title', 'id="product-price-'),
+        # Підмножина сторінки, яку достатньо розібрати для пошуку назви і ціни
+        "strainer": {"id": "maincontent"},
+        "structured": True
     },
     "fayni-mebli": {
+        "host": "fayni-mebli.com",
         "title": "main header h1",          # більш загальний селектор для заголовку продукту
-        "price": "main form dl dt span" 
+        "price": "main form dl dt span",
+        "region": ('class="product-header"', 'class="product-price"'),
+        "strainer": {"name": "main"},
+        "structured": True
     }
 }
 
+# Реєстр сайтів: нормалізований домен -> ключ налаштувань у SCRAPING_CONFIG
+SITE_ADAPTERS = {config["host"]: site for site, config in SCRAPING_CONFIG.items()}
+# Піддомени, які відкидаємо перед пошуком у реєстрі
+HOST_PREFIXES = ("www.", "m.", "mobile.")
+
+def normalize_host(host: str) -> str:
+    """Приводимо домен до вигляду з реєстру: нижній регістр, без www. та мобільних піддоменів."""
+    host = (host or "").lower().rstrip(".")
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix):
+            return host[len(prefix):]
+    return host
+
 def detect_site(url: str):
     """
     Визначаємо, з якого сайту прийшов URL, і повертаємо відповідний ключ для налаштувань скрейпінгу.
+    Пошук у реєстрі за доменом не залежить від кількості підтримуваних сайтів.
     """
-    if "pufetto.com.ua" in url:
-        return "pufetto"
-    elif "mebli-city.com.ua" in url:
-        return "mebli-city"
-    elif "fayni-mebli.com" in url:
-        return "fayni-mebli"
-    else:
+    try:
+        return SITE_ADAPTERS.get(normalize_host(urlsplit(url).hostname))
+    except ValueError:
         return None
 
-# -------------------- Функція скрейпінгу (без lxml) -------------------- #
-def scrape_custom(url: str, config: dict):
+# -------------------- HTTP-клієнт -------------------- #
+# Одна сесія aiohttp на весь процес: з'єднання з кожним сайтом тримаються
+# відкритими (keep-alive) і повторно використовуються між запитами.
+# Стиснення (gzip/deflate) aiohttp запитує й розпаковує автоматично.
+FETCH_HEADERS = {"User-Agent": "Mozilla/5.0"}
+FETCH_TIMEOUT = aiohttp.ClientTimeout(
+    total=FETCH_TOTAL_TIMEOUT,
+    sock_connect=FETCH_CONNECT_TIMEOUT,
+    sock_read=FETCH_READ_TIMEOUT,
+)
+# Статуси відповіді, після яких запит варто повторити
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_http_session = None
+_global_fetch_semaphore = None
+_host_fetch_semaphores = {}
+# Запобіжники: домен сайту -> CircuitBreaker
+_circuit_breakers = {}
+
+class CircuitOpenError(Exception):
+    """Запит не надіслано, бо запобіжник сайту розімкнений."""
+
+class CircuitBreaker:
     """
-    Скрейпимо сторінку за заданим URL, використовуючи кастомну конфігурацію.
-    Для цього ми використовуємо requests та BeautifulSoup з CSS-селекторами.
-    Повертаємо кортеж: (заголовок, текст ціни, час отримання даних).
+    Запобіжник для одного сайту. Замкнений — запити проходять; після
+    threshold помилок поспіль розмикається на cooldown секунд, потім
+    пропускає один пробний запит: успіх замикає його, помилка — знову розмикає.
+    """
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, host: str, threshold: int, cooldown: float):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = 0.0
+        self._set_state(self.CLOSED)
+
+    def _set_state(self, state: str):
+        self.state = state
+        CIRCUIT_STATE.set(self.STATE_VALUES[state], host=self.host)
+
+    def allow(self) -> bool:
+        """Повертаємо True, якщо запит до сайту можна надіслати."""
+        if self.state == self.CLOSED:
+            return True
+        # Пробний запит дозволяємо раз на cooldown, навіть якщо попередній
+        # пробний запит так і не повідомив результат (наприклад, був скасований)
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            self.opened_at = time.monotonic()
+            self._set_state(self.HALF_OPEN)
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        if self.state != self.CLOSED:
+            logging.info(f"Сайт {self.host} знову відповідає; запобіжник замкнено.")
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            logging.warning(f"Сайт {self.host}: {self.failures} помилок поспіль; "
+                            f"запобіжник розімкнено на {self.cooldown} с.")
+            self.opened_at = time.monotonic()
+            self._set_state(self.OPEN)
+
+def get_circuit_breaker(host: str) -> CircuitBreaker:
+    """Повертаємо запобіжник сайту, створюючи його за потреби."""
+    breaker = _circuit_breakers.get(host)
+    if breaker is None:
+        breaker = _circuit_breakers[host] = CircuitBreaker(host, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_COOLDOWN)
+    return breaker
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Повертаємо спільну HTTP-сесію, створюючи її при першому виклику."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=FETCH_GLOBAL_LIMIT,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        )
+        _http_session = aiohttp.ClientSession(connector=connector, headers=FETCH_HEADERS)
+    return _http_session
+
+async def close_http_session():
+    """Закриваємо спільну HTTP-сесію під час зупинки бота."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+def _get_fetch_semaphores(host: str):
+    """Повертаємо глобальний семафор та семафор для конкретного сайту."""
+    global _global_fetch_semaphore
+    if _global_fetch_semaphore is None:
+        _global_fetch_semaphore = asyncio.Semaphore(FETCH_GLOBAL_LIMIT)
+    host_semaphore = _host_fetch_semaphores.get(host)
+    if host_semaphore is None:
+        limit = FETCH_HOST_LIMITS.get(host, FETCH_DEFAULT_HOST_LIMIT)
+        host_semaphore = _host_fetch_semaphores[host] = asyncio.Semaphore(limit)
+    return _global_fetch_semaphore, host_semaphore
+
+def _retry_delay(attempt: int, retry_after=None) -> float:
+    """Затримка перед повтором: експоненційна з випадковим розкидом (або Retry-After сайту)."""
+    delay = random.uniform(0, min(FETCH_RETRY_MAX_DELAY, FETCH_RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after is not None and retry_after.isdigit():
+        delay = max(delay, min(int(retry_after), FETCH_RETRY_MAX_DELAY))
+    return delay
+
+async def fetch_page(url: str, headers: dict = None):
     """
+    Завантажуємо сторінку з урахуванням лімітів одночасних запитів і тайм-аутів.
+    Після тимчасових помилок повторюємо запит до FETCH_RETRIES разів; чекаючи
+    повтору, не займаємо місце в лімітах, тож інші сайти не сповільнюються.
+    Якщо запобіжник сайту розімкнений, одразу кидаємо CircuitOpenError.
+    Повертаємо кортеж: (статус, ETag, Last-Modified, вміст сторінки).
+    Вміст дорівнює None, якщо сервер відповів не 200.
+    """
+    host = normalize_host(urlsplit(url).hostname)
+    global_semaphore, host_semaphore = _get_fetch_semaphores(host)
+    breaker = get_circuit_breaker(host)
+    for attempt in range(FETCH_RETRIES + 1):
+        if not breaker.allow():
+            CIRCUIT_REJECTED.inc(host=host)
+            raise CircuitOpenError(host)
+        retry_after = None
+        try:
+            async with host_semaphore, global_semaphore:
+                async with get_http_session().get(url, headers=headers, timeout=FETCH_TIMEOUT) as response:
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+                    if response.status not in RETRY_STATUSES:
+                        content = await response.read() if response.status == 200 else None
+                        breaker.record_success()
+                        return response.status, etag, last_modified, content
+                    breaker.record_failure()
+                    if attempt == FETCH_RETRIES:
+                        return response.status, etag, last_modified, None
+                    reason = f"http_{response.status}"
+                    retry_after = response.headers.get("Retry-After")
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            breaker.record_failure()
+            if attempt == FETCH_RETRIES:
+                raise
+            reason = "timeout" if isinstance(e, asyncio.TimeoutError) else "connection"
+        FETCH_RETRY_COUNT.inc(host=host, reason=reason)
+        await asyncio.sleep(_retry_delay(attempt, retry_after))
+
+# -------------------- Розбір сторінок -------------------- #
+# Якщо встановлено lxml (C-парсер), використовуємо його для швидкого розбору;
+# інакше швидкий шлях працює лише для сайтів із "strainer" на html.parser.
+FAST_HTML_PARSER = "lxml" if find_spec("lxml") else "html.parser"
+
+# Заздалегідь скомпільовані CSS-селектори та SoupStrainer для кожного сайту
+COMPILED_SELECTORS = {
+    site: {
+        "title": soupsieve.compile(config["title"]),
+        "price": soupsieve.compile(config["price"]),
+        "strainer": SoupStrainer(**config["strainer"]) if "strainer" in config else None,
+    }
+    for site, config in SCRAPING_CONFIG.items()
+}
+
+# Сайти, для яких швидкий розбір дав інший результат, ніж повний.
+# Цей стан і лічильники ведемо лише в головному процесі (див. parse_in_pool):
+# у процесів пулу розбору власні копії глобальних змінних.
+_fast_extraction_disabled = set()
+# Лічильники сторінок, переданих на розбір зі швидким шляхом: сайт -> кількість
+_fast_extraction_counts = {}
+
+def _select_text(soup, compiled: dict):
+    """Повертаємо (заголовок, текст ціни) зі скомпільованих селекторів; None для відсутніх."""
+    title_elem = compiled["title"].select_one(soup)
+    price_elem = compiled["price"].select_one(soup)
+    title = title_elem.get_text(strip=True) if title_elem else None
+    price_text = price_elem.get_text(strip=True) if price_elem else None
+    return title, price_text
+
+# Регулярні вирази для структурованих даних: їх можна знайти без побудови дерева DOM
+JSON_LD_RE = re.compile(rb'<script[^>]+type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.S | re.I)
+META_RE = re.compile(rb'<meta\s[^>]*>', re.I)
+# Значення атрибута закінчується лапкою того ж виду, що й відкриває його:
+# в назвах на кшталт "М'який диван" апостроф не обриває значення
+META_ATTR_RE = re.compile(rb'(property|name|itemprop|content)\s*=\s*(["\'])(.*?)\2', re.S | re.I)
+META_PRICE_KEYS = (b"product:price:amount", b"og:price:amount", b"price")
+META_TITLE_KEYS = (b"og:title",)
+# Назви, коротші за стільки символів, вважаємо обрізаними і розбираємо сторінку селекторами
+STRUCTURED_TITLE_MIN_LENGTH = 3
+
+def _structured_title_ok(title: str) -> bool:
+    """Чи схожа назва зі структурованих даних на повну (а не обрізану біля апострофа)."""
+    return len(title) >= STRUCTURED_TITLE_MIN_LENGTH and title[-1] not in "'’ʼ"
+
+def _find_json_ld_product(data):
+    """Шукаємо в розібраному JSON-LD об'єкт Product з пропозицією (Offer) і ціною."""
+    if isinstance(data, list):
+        for item in data:
+            found = _find_json_ld_product(item)
+            if found:
+                return found
+        return None
+    if not isinstance(data, dict):
+        return None
+    if "@graph" in data:
+        return _find_json_ld_product(data["@graph"])
+    types = data.get("@type")
+    types = types if isinstance(types, list) else [types]
+    if "Product" in types and data.get("name"):
+        offers = data.get("offers")
+        offers = offers[0] if isinstance(offers, list) and offers else offers
+        if isinstance(offers, dict):
+            price = offers.get("price", offers.get("lowPrice"))
+            if price not in (None, ""):
+                return str(data["name"]).strip(), str(price)
+    return None
+
+def extract_structured(content: bytes, site: str):
+    """
+    Найдешевший спосіб: беремо назву і ціну зі структурованих даних сторінки —
+    schema.org JSON-LD (Product/Offer) або мета-тегів product:price:amount / og:title
+    у <head>. Дерево DOM не будуємо. Повертаємо None, якщо даних немає
+    або для сайту вказано "structured": False.
+    """
+    if not SCRAPING_CONFIG[site]["structured"]:
+        return None
+    for match in JSON_LD_RE.finditer(content):
+        try:
+            found = _find_json_ld_product(json.loads(match.group(1)))
+        except ValueError:
+            continue
+        if found and _structured_title_ok(found[0]):
+            return found
+
+    head_end = content.find(b"</head>")
+    head = content[:head_end] if head_end != -1 else content
+    meta = {}
+    for tag in META_RE.findall(head):
+        attrs = {key.lower(): value for key, _, value in META_ATTR_RE.findall(tag)}
+        key = attrs.get(b"property") or attrs.get(b"name") or attrs.get(b"itemprop")
+        if key and b"content" in attrs:
+            meta.setdefault(key.lower(), attrs[b"content"])
+    price = next((meta[key] for key in META_PRICE_KEYS if meta.get(key)), None)
+    title = next((meta[key] for key in META_TITLE_KEYS if meta.get(key)), None)
+    if price and title:
+        title = html.unescape(title.decode("utf-8", "replace")).strip()
+        if _structured_title_ok(title):
+            return title, price.decode("utf-8", "replace")
+    return None
+
+def fast_extraction_available(site: str) -> bool:
+    """Чи має сайт швидкий шлях: потрібен "strainer" у SCRAPING_CONFIG або парсер lxml."""
+    return COMPILED_SELECTORS[site]["strainer"] is not None or FAST_HTML_PARSER != "html.parser"
+
+def extract_fast(content: bytes, site: str):
+    """
+    Швидкий розбір: будуємо дерево лише для потрібної частини сторінки (SoupStrainer)
+    та/або C-парсером lxml. Повертаємо (заголовок, текст ціни) або None,
+    якщо щось не знайдено і потрібен повний розбір.
+    """
+    if not fast_extraction_available(site):
+        return None
+    compiled = COMPILED_SELECTORS[site]
+    soup = BeautifulSoup(content, FAST_HTML_PARSER, parse_only=compiled["strainer"])
+    title, price_text = _select_text(soup, compiled)
+    if title is None or price_text is None:
+        return None
+    return title, price_text
+
+def extract_full(content: bytes, site: str):
+    """Повний розбір сторінки через html.parser, як і раніше."""
+    soup = BeautifulSoup(content, "html.parser")
+    title, price_text = _select_text(soup, COMPILED_SELECTORS[site])
+    return title or "Заголовок не знайдено", price_text or "Ціну не знайдено"
+
+# Способи розбору сторінки в порядку спроб; кожен повертає (заголовок, ціна) або None
+EXTRACTION_ENGINES = [extract_structured, extract_fast, extract_full]
+
+def parse_page(content: bytes, site: str, use_fast: bool = True):
+    """
+    Розбираємо HTML сторінки, по черзі пробуючи способи з EXTRACTION_ENGINES
+    (use_fast=False пропускає швидкий розбір). Повертаємо кортеж: (заголовок, текст ціни).
+    """
+    return _parse_page_checked(content, site, use_fast, False)[:2]
+
+def _parse_page_checked(content: bytes, site: str, use_fast: bool, check_parity: bool):
+    """
+    Розбір сторінки в процесі пулу. Якщо check_parity і сторінку розібрано швидким
+    шляхом, звіряємо результат з повним розбором і при розбіжності повертаємо повний.
+    Повертаємо (заголовок, текст ціни, parity): parity — результат звірки або None,
+    якщо звірки не було. Що робити з розбіжністю, вирішує головний процес.
+    """
+    for engine in EXTRACTION_ENGINES:
+        if engine is extract_fast and not use_fast:
+            continue
+        result = engine(content, site)
+        if result is None:
+            continue
+        if engine is extract_fast and check_parity:
+            full = extract_full(content, site)
+            return (*full, False) if full != result else (*result, True)
+        return (*result, None)
+    return "Заголовок не знайдено", "Ціну не знайдено", None
+
+_parse_executor = None
+_parse_semaphore = None
+_parse_pending = 0
+
+def get_parse_executor():
+    """
+    Повертаємо пул процесів для розбору сторінок (або None, якщо PARSE_PROCESSES=0,
+    тоді розбір виконується у стандартному пулі потоків).
+    Процеси запускаються методом spawn, щоб не успадковувати потоки та з'єднання бота.
+    """
+    global _parse_executor
+    if _parse_executor is None and PARSE_PROCESSES > 0:
+        _parse_executor = ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                              mp_context=multiprocessing.get_context("spawn"))
+    return _parse_executor
+
+def shutdown_parse_executor():
+    """Зупиняємо пул процесів розбору під час зупинки бота."""
+    global _parse_executor
+    if _parse_executor is not None:
+        _parse_executor.shutdown(wait=False, cancel_futures=True)
+        _parse_executor = None
+
+async def parse_in_pool(content: bytes, site: str):
+    """
+    Передаємо сирий HTML у пул процесів і отримуємо (заголовок, текст ціни).
+    Якщо пул зайнятий і черга заповнена, чекаємо (зворотний тиск на скрейпінг).
+    Кожну EXTRACTION_PARITY_CHECK_EVERY-ту сторінку сайту просимо процес звірити
+    швидкий розбір з повним; при розбіжності вимикаємо швидкий розбір для сайту.
+    """
+    global _parse_semaphore, _parse_pending
+    if _parse_semaphore is None:
+        _parse_semaphore = asyncio.Semaphore(max(PARSE_PROCESSES, 1) * PARSE_QUEUE_PER_PROCESS)
+    use_fast = site not in _fast_extraction_disabled
+    check_parity = False
+    if use_fast:
+        count = _fast_extraction_counts.get(site, 0) + 1
+        _fast_extraction_counts[site] = count
+        check_parity = count % EXTRACTION_PARITY_CHECK_EVERY == 0
+    _parse_pending += 1
     try:
-        import requests
-        headers = {"User-Agent": "Mozilla/5.0"}
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            return None, None, None
+        async with _parse_semaphore:
+            loop = asyncio.get_running_loop()
+            title, price_text, parity = await loop.run_in_executor(
+                get_parse_executor(), _parse_page_checked, content, site, use_fast, check_parity)
+    finally:
+        _parse_pending -= 1
+    if parity is False and site not in _fast_extraction_disabled:
+        logging.warning(f"Швидкий розбір для {site} розійшовся з повним ({title!r}, {price_text!r}). "
+                        f"Вимикаємо швидкий розбір для цього сайту.")
+        _fast_extraction_disabled.add(site)
+    return title, price_text
 
-        content = response.content
-        soup = BeautifulSoup(content, "html.parser")
-        title_elem = soup.select_one(config["title"])
-        title = title_elem.get_text(strip=True) if title_elem else "Заголовок не знайдено"
+def check_extraction_parity(content: bytes, site: str) -> bool:
+    """
+    Перевіряємо, що швидкий розбір сторінки спрацював і дав той самий результат,
+    що й повний. Сайт без швидкого шляху (див. fast_extraction_available) не перевіряємо.
+    """
+    if not fast_extraction_available(site):
+        return True
+    fast = extract_fast(content, site)
+    return fast is not None and fast == extract_full(content, site)
 
-        price_elem = soup.select_one(config["price"])
-        price_text = price_elem.get_text(strip=True) if price_elem else "Ціну не знайдено"
+def region_hash(content: bytes, site: str) -> str:
+    """
+    Рахуємо хеш фрагментів сторінки, що починаються з маркерів "region" сайту.
+    Якщо хоча б один маркер не знайдено, хешуємо всю сторінку.
+    """
+    markers = SCRAPING_CONFIG[site].get("region", ())
+    if not markers:
+        return hashlib.sha1(content).hexdigest()
+    digest = hashlib.sha1()
+    for marker in markers:
+        start = content.find(marker.encode())
+        if start == -1:
+            return hashlib.sha1(content).hexdigest()
+        digest.update(content[start:start + REGION_HASH_WINDOW])
+    return digest.hexdigest()
 
+async def scrape_custom(url: str, site: str):
+    """
+    Скрейпимо сторінку за заданим URL, використовуючи налаштування сайту site.
+    Сторінку завантажуємо асинхронно через спільну сесію aiohttp умовним запитом
+    (If-None-Match / If-Modified-Since). Якщо сервер відповів 304 або хеш фрагмента
+    з назвою і ціною не змінився, повертаємо збережені дані без розбору HTML.
+    Інакше розбираємо HTML в окремому процесі (див. parse_in_pool).
+    Разом зі сторінкою зберігаємо час наступної перевірки (див. refresh_interval).
+    Повертаємо кортеж: (заголовок, текст ціни, час отримання даних).
+    """
+    try:
+        cached = await run_db(get_page_cache, url)
+        now = time.time()
+        # Збережені дані можна використати, якщо їх не розбирали надто давно
+        reusable = cached is not None and now - (cached[6] or 0) < PAGE_REPARSE_MAX_AGE
+        headers = {}
+        if reusable:
+            if cached[0]:
+                headers["If-None-Match"] = cached[0]
+            if cached[1]:
+                headers["If-Modified-Since"] = cached[1]
+
+        fetch_start = time.perf_counter()
+        status, etag, last_modified, content = await fetch_page(url, headers)
+        FETCH_SECONDS.observe(time.perf_counter() - fetch_start, site=site)
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        if status == 304 and reusable:
+            SCRAPE_RESULTS.inc(site=site, result="not_modified")
+            changed_at = cached[7] or cached[6]
+            await run_db(save_page_cache, url, etag or cached[0], last_modified or cached[1], cached[2],
+                         cached[3], cached[4], now, cached[6], changed_at, now + refresh_interval(changed_at, now))
+            return cached[3], cached[4], timestamp
+        if content is None:
+            SCRAPE_RESULTS.inc(site=site, result="http_error")
+            return None, None, None
+
+        content_hash = region_hash(content, site)
+        if reusable and content_hash == cached[2]:
+            SCRAPE_RESULTS.inc(site=site, result="unchanged")
+            title, price_text, parsed_at = cached[3], cached[4], cached[6]
+        else:
+            parse_start = time.perf_counter()
+            title, price_text = await parse_in_pool(content, site)
+            PARSE_SECONDS.observe(time.perf_counter() - parse_start, site=site)
+            SCRAPE_RESULTS.inc(site=site, result="parsed")
+            parsed_at = now
+
+        if cached is None or price_text != cached[4]:
+            changed_at = now
+        else:
+            changed_at = cached[7] or cached[6]
+        await run_db(save_page_cache, url, etag, last_modified, content_hash, title, price_text, now, parsed_at,
+                     changed_at, now + refresh_interval(changed_at, now))
         return title, price_text, timestamp
 
+    except CircuitOpenError:
+        SCRAPE_RESULTS.inc(site=site, result="circuit_open")
+        return None, None, None
     except Exception as e:
+        SCRAPE_RESULTS.inc(site=site, result="error")
         logging.error(f"Помилка скрейпінгу {url}: {e}")
         return None, None, None
 
+# -------------------- Спільний скрейпінг однакових URL -------------------- #
+# Кеш результатів: url -> (час отримання за time.monotonic(), (заголовок, ціна, час))
+_scrape_cache = {}
+# Запити, які зараз виконуються: url -> asyncio.Task
+_scrape_inflight = {}
+
+async def scrape_cached(url: str, site: str):
+    """
+    Скрейпимо URL не частіше, ніж раз на SCRAPE_CACHE_TTL секунд.
+    Якщо такий самий URL уже завантажується, приєднуємося до цього запиту,
+    а свіжий результат повторно використовуємо для всіх користувачів.
+    Повертаємо той самий кортеж, що й scrape_custom.
+    """
+    cached = _scrape_cache.get(url)
+    if cached and time.monotonic() - cached[0] < SCRAPE_CACHE_TTL:
+        return cached[1]
+
+    task = _scrape_inflight.get(url)
+    if task is None:
+        task = asyncio.create_task(_scrape_and_cache(url, site))
+        _scrape_inflight[url] = task
+    # shield: якщо один з очікувачів скасований, запит для інших не переривається
+    return await asyncio.shield(task)
+
+async def _scrape_and_cache(url: str, site: str):
+    """Виконуємо один реальний скрейпінг і зберігаємо успішний результат у кеші."""
+    try:
+        result = await scrape_custom(url, site)
+    finally:
+        _scrape_inflight.pop(url, None)
+    # Невдалі спроби не кешуємо, щоб наступний запит міг спробувати ще раз
+    if result[0] is not None and result[1] is not None:
+        _scrape_cache[url] = (time.monotonic(), result)
+        price = parse_price(result[1])
+        if price is not None:
+            try:
+                await run_db(record_price_point, url, price, time.time())
+            except Exception as e:
+                logging.error(f"Не вдалося записати історію ціни для {url}: {e}")
+    _prune_scrape_cache()
+    return result
+
+def _prune_scrape_cache():
+    """Видаляємо з кешу застарілі записи, щоб він не ріс безмежно."""
+    now = time.monotonic()
+    expired = [url for url, (fetched, _) in _scrape_cache.items() if now - fetched >= SCRAPE_CACHE_TTL]
+    for url in expired:
+        del _scrape_cache[url]
+
 def parse_price(price_text: str):
     """
     Обробляємо текст з ціною, залишаючи лише цифри та розділові знаки,
@@ -211,6 +1524,299 @@ def parse_price(price_text: str):
     except ValueError:
         return None
 
+# -------------------- Політика повторного завантаження продуктів -------------------- #
+# Для кожного сайту: TokenBucket з бюджетом повторних завантажень на годину
+_refresh_budgets = {}
+
+def refresh_interval(changed_at, now: float) -> float:
+    """
+    Повертаємо, через скільки секунд сторінку варто завантажити знову.
+    Чим довше ціна не змінювалася, тим рідше перевіряємо продукт.
+    """
+    stable_for = now - changed_at if changed_at else 0
+    return min(max(stable_for * REFRESH_BACKOFF_FACTOR, REFRESH_MIN_INTERVAL), REFRESH_MAX_INTERVAL)
+
+def take_refresh_budget(site: str) -> bool:
+    """
+    Забираємо одне повторне завантаження з годинного бюджету сайту.
+    Повертаємо False, якщо бюджет вичерпано.
+    """
+    host = SCRAPING_CONFIG[site]["host"]
+    bucket = _refresh_budgets.get(host)
+    if bucket is None:
+        budget = REFRESH_SITE_BUDGETS.get(host, REFRESH_DEFAULT_SITE_BUDGET)
+        bucket = _refresh_budgets[host] = TokenBucket(budget / 3600, budget)
+    return bucket.try_acquire()
+
+# -------------------- Черга вихідних повідомлень -------------------- #
+# Усі повідомлення користувачам проходять через черги з пріоритетами: окрему для
+# кожного чату і спільну чергу чатів, готових до надсилання. Чат потрапляє у спільну
+# чергу лише тоді, коли в його відрі є токен, тож обробники не простоюють на ліміті
+# одного чату, поки загальний ліміт Telegram не вичерпано.
+# Відповіді на команди мають вищий пріоритет, ніж щоденні розсилки.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+class TokenBucket:
+    """Відро токенів: у середньому не більше rate подій на секунду, поспіль — не більше capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self) -> bool:
+        """Повертаємо True, якщо відро повністю наповнене (ним давно не користувалися)."""
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def wait_time(self) -> float:
+        """Скільки секунд чекати, доки з'явиться токен (0, якщо він уже є)."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def try_acquire(self) -> bool:
+        """Забираємо токен без очікування; повертаємо False, якщо токенів немає."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        """Чекаємо, доки з'явиться токен, і забираємо його."""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Черга чатів, готових до надсилання: (пріоритет, номер, chat_id) першого повідомлення чату
+_outbox = None
+_outbox_seq = itertools.count()
+_global_send_bucket = None
+# Для кожного чату: [TokenBucket, asyncio.Lock]; замок зберігає порядок повідомлень у чаті
+_chat_send_state = {}
+# Повідомлення, що чекають надсилання: chat_id -> купа (пріоритет, номер, текст, kwargs, future)
+_chat_outboxes = {}
+# Чати, які стоять у _outbox, чекають на токен або зараз надсилаються
+_scheduled_chats = set()
+
+def outbox_size() -> int:
+    """Скільки повідомлень чекає надсилання."""
+    return sum(len(queue) for queue in _chat_outboxes.values())
+
+def _ensure_outbox():
+    """Створюємо чергу та запускаємо її обробники при першому використанні."""
+    global _outbox, _global_send_bucket
+    if _outbox is None:
+        _outbox = asyncio.PriorityQueue()
+        _global_send_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        for _ in range(OUTBOX_WORKERS):
+            start_background_task(_outbox_worker())
+    return _outbox
+
+def _get_chat_send_state(chat_id: int):
+    """Повертаємо відро токенів і замок для чату, прибираючи стан неактивних чатів."""
+    state = _chat_send_state.get(chat_id)
+    if state is None:
+        if len(_chat_send_state) > 10000:
+            for idle_chat in [chat for chat, (bucket, lock) in _chat_send_state.items()
+                              if bucket.is_idle() and not lock.locked()]:
+                del _chat_send_state[idle_chat]
+        state = _chat_send_state[chat_id] = [TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST), asyncio.Lock()]
+    return state
+
+def _schedule_chat(chat_id: int):
+    """
+    Ставимо чат у чергу готових, щойно в його відрі з'явиться токен.
+    Якщо повідомлень для чату більше немає, забуваємо про нього.
+    """
+    if not _chat_outboxes.get(chat_id):
+        _chat_outboxes.pop(chat_id, None)
+        _scheduled_chats.discard(chat_id)
+        return
+    _scheduled_chats.add(chat_id)
+    bucket, _ = _get_chat_send_state(chat_id)
+    delay = bucket.wait_time()
+    if delay > 0:
+        asyncio.get_running_loop().call_later(delay, _mark_chat_ready, chat_id)
+    else:
+        _mark_chat_ready(chat_id)
+
+def _mark_chat_ready(chat_id: int):
+    """Передаємо чат обробникам з пріоритетом його першого повідомлення."""
+    priority, seq = _chat_outboxes[chat_id][0][:2]
+    _outbox.put_nowait((priority, seq, chat_id))
+
+async def _outbox_worker():
+    """
+    Беремо з черги готовий чат і надсилаємо його перше повідомлення
+    з урахуванням лімітів та RetryAfter, після чого знову плануємо чат.
+    """
+    while True:
+        # Спершу чекаємо загального токена, а вже потім беремо чат: так наступне
+        # повідомлення обирається з черги в мить надсилання і відповіді на команди
+        # не стоять за розсилками, що чекають загального ліміту
+        await _global_send_bucket.acquire()
+        _, _, chat_id = await _outbox.get()
+        _, _, text, kwargs, future = heapq.heappop(_chat_outboxes[chat_id])
+        try:
+            bucket, lock = _get_chat_send_state(chat_id)
+            async with lock:
+                await bucket.acquire()
+                while True:
+                    send_start = time.perf_counter()
+                    try:
+                        result = await bot.send_message(chat_id, text, **kwargs)
+                        SEND_SECONDS.observe(time.perf_counter() - send_start)
+                        SEND_RESULTS.inc(result="ok")
+                        break
+                    except TelegramRetryAfter as e:
+                        SEND_RESULTS.inc(result="retry_after")
+                        logging.warning(f"Telegram просить зачекати {e.retry_after} с перед надсиланням у чат {chat_id}.")
+                        await asyncio.sleep(e.retry_after)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            SEND_RESULTS.inc(result="error")
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            _outbox.task_done()
+            _schedule_chat(chat_id)
+
+def split_message(text: str, limit: int = None):
+    """
+    Ділимо текст на частини не довші за limit символів (TELEGRAM_MESSAGE_LIMIT за замовчуванням).
+    Ділимо по порожніх рядках між блоками, а задовгі блоки — по рядках або посимвольно.
+    """
+    limit = limit or TELEGRAM_MESSAGE_LIMIT
+    chunks = []
+    current = ""
+    for block in text.split("\n\n"):
+        candidate = f"{current}\n\n{block}" if current else block
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            chunks.append(current)
+        while len(block) > limit:
+            cut = block.rfind("\n", 0, limit)
+            if cut <= 0:
+                cut = limit
+            chunks.append(block[:cut])
+            block = block[cut:].lstrip("\n")
+        current = block
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def send_text(chat_id: int, text: str, priority: int = PRIORITY_BULK, **kwargs):
+    """
+    Ставимо текст у чергу на надсилання, розбивши його на повідомлення
+    допустимої довжини, і чекаємо, доки всі частини буде надіслано.
+    Повертаємо список надісланих повідомлень.
+    """
+    _ensure_outbox()
+    loop = asyncio.get_running_loop()
+    queue = _chat_outboxes.setdefault(chat_id, [])
+    futures = []
+    for chunk in split_message(text):
+        future = loop.create_future()
+        heapq.heappush(queue, (priority, next(_outbox_seq), chunk, kwargs, future))
+        futures.append(future)
+        # Відповідь прикріплюємо лише до першої частини
+        kwargs = {key: value for key, value in kwargs.items() if key != "reply_to_message_id"}
+    if chat_id not in _scheduled_chats:
+        _schedule_chat(chat_id)
+    return await asyncio.gather(*futures)
+
+async def edit_text(sent_message: types.Message, text: str):
+    """
+    Редагуємо раніше надіслане повідомлення з урахуванням лімітів Telegram.
+    Помилки редагування лише записуємо в журнал.
+    """
+    if sent_message is None:
+        return
+    chat_id = sent_message.chat.id
+    _ensure_outbox()
+    bucket, lock = _get_chat_send_state(chat_id)
+    try:
+        async with lock:
+            await bucket.acquire()
+            await _global_send_bucket.acquire()
+            while True:
+                try:
+                    await bot.edit_message_text(split_message(text)[0], chat_id=chat_id,
+                                                message_id=sent_message.message_id)
+                    return
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+    except Exception as e:
+        logging.error(f"Не вдалося відредагувати повідомлення в чаті {chat_id}: {e}")
+
+async def send_document(chat_id: int, path: str, filename: str, **kwargs):
+    """
+    Надсилаємо файл з диска з урахуванням лімітів Telegram.
+    Файл читається частинами під час надсилання, а не завантажується в пам'ять.
+    """
+    _ensure_outbox()
+    bucket, lock = _get_chat_send_state(chat_id)
+    async with lock:
+        await bucket.acquire()
+        await _global_send_bucket.acquire()
+        while True:
+            send_start = time.perf_counter()
+            try:
+                result = await bot.send_document(chat_id, types.FSInputFile(path, filename=filename), **kwargs)
+                SEND_SECONDS.observe(time.perf_counter() - send_start)
+                SEND_RESULTS.inc(result="ok")
+                return result
+            except TelegramRetryAfter as e:
+                SEND_RESULTS.inc(result="retry_after")
+                await asyncio.sleep(e.retry_after)
+
+async def reply(message: types.Message, text: str):
+    """Відповідаємо на повідомлення користувача через пріоритетну чергу."""
+    sent = await send_text(message.chat.id, text, PRIORITY_INTERACTIVE, reply_to_message_id=message.message_id)
+    return sent[0] if sent else None
+
+# -------------------- Обмеження одночасних оновлень -------------------- #
+# Оновлення від Telegram обробляються паралельно (і в режимі polling, і webhook),
+# але не більше MAX_UPDATES_IN_FLIGHT одночасно, щоб сплеск команд не виснажив
+# з'єднання з базою та ліміти скрейпінгу.
+_update_semaphore = None
+_updates_in_flight = 0
+
+@dp.update.outer_middleware()
+async def limit_updates_in_flight(handler, event: types.Update, data: dict):
+    """Проміжний обробник, який обмежує кількість оновлень в обробці."""
+    global _update_semaphore, _updates_in_flight
+    if _update_semaphore is None:
+        _update_semaphore = asyncio.Semaphore(MAX_UPDATES_IN_FLIGHT)
+    async with _update_semaphore:
+        _updates_in_flight += 1
+        try:
+            return await handler(event, data)
+        finally:
+            _updates_in_flight -= 1
+
+async def wait_for_updates_in_flight(timeout: float):
+    """Чекаємо до timeout секунд, доки завершиться обробка поточних оновлень."""
+    deadline = time.monotonic() + timeout
+    while _updates_in_flight and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if _updates_in_flight:
+        logging.warning(f"Зупинка: не дочекалися завершення {_updates_in_flight} оновлень.")
+
 # -------------------- Обробники команд бота -------------------- #
 @dp.message(Command("start", "help"))
 async def send_welcome(message: types.Message):
@@ -221,10 +1827,14 @@ async def send_welcome(message: types.Message):
         "• /delete <url> — Видалити продукт із відстеження.\n"
         "• /check [<url>] — Перевірити актуальні дані продукту (якщо URL не вказано, перевіряються всі відстежувані продукти).\n"
         "• /list — Показати всі продукти, які ви відстежуєте.\n"
-        "• /settime <HH:MM> — Встановити час для щоденних оновлень.\n\n"
+        "• /settime <HH:MM> — Встановити час для щоденних оновлень.\n"
+        "• /history <url> — Показати історію зміни ціни продукту.\n"
+        "• /import <посилання> — Додати багато продуктів одразу (посилання в тексті або у файлі з підписом /import).\n"
+        "• /export — Отримати CSV-файл з продуктами та історією їхніх цін.\n"
+        "• /notify — Налаштувати, про що повідомляти в щоденних оновленнях.\n\n"
         "При кожному оновленні даних інформація та час зберігаються."
     )
-    await message.reply(welcome_text)
+    await reply(message, welcome_text)
 
 @dp.message(Command("add"))
 async def add_handler(message: types.Message):
@@ -234,40 +1844,38 @@ async def add_handler(message: types.Message):
     """
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
-        await message.reply("Будь ласка, введіть команду у форматі: /add <url>")
+        await reply(message, "Будь ласка, введіть команду у форматі: /add <url>")
         return
 
     url = parts[1].strip()
     if not (url.startswith("http://") or url.startswith("https://")):
-        await message.reply("Переконайтеся, що URL починається з http:// або https://")
+        await reply(message, "Переконайтеся, що URL починається з http:// або https://")
         return
 
-    if get_tracked_product(message.from_user.id, url):
-        await message.reply("Цей продукт уже відстежується.")
+    if any(prod[1] == url for prod in await get_user_products(message.from_user.id)):
+        await reply(message, "Цей продукт уже відстежується.")
         return
 
     site = detect_site(url)
     if not site:
-        await message.reply("❌ Невідомий сайт. Підтримуються: Pufetto, Mebli‑City, Файні меблі.")
+        await reply(message, "❌ Невідомий сайт. Підтримуються: Pufetto, Mebli‑City, Файні меблі.")
         return
 
-    config = SCRAPING_CONFIG[site]
-    loop = asyncio.get_running_loop()
-    title, price_text, timestamp = await loop.run_in_executor(None, scrape_custom, url, config)
+    title, price_text, timestamp = await scrape_cached(url, site)
     if title is None or price_text is None:
-        await message.reply("Не вдалося отримати дані зі сторінки. Перевірте, будь ласка, посилання.")
+        await reply(message, "Не вдалося отримати дані зі сторінки. Перевірте, будь ласка, посилання.")
         return
 
     price = parse_price(price_text)
     if price is None:
-        await message.reply("Не вдалося визначити ціну.")
+        await reply(message, "Не вдалося визначити ціну.")
         return
 
     # Додаємо продукт з початковою зміною ціни 0%
-    add_tracked_product(message.from_user.id, url, title, str(price), timestamp)
-    await message.reply(
-        f"Продукт додано!\nЗаголовок: {title}\nЦіна: {price} грн\nЗміна: {0:+.2f}%\nЧас: {timestamp}"
-    )
+    await run_db(add_tracked_product, message.from_user.id, url, title, price, timestamp)
+    invalidate_user_products(message.from_user.id)
+    await reply(message, f"Продукт додано!\nЗаголовок: {title}\nЦіна: {price} грн\n"
+                         f"Зміна: {0:+.2f}%\nЧас: {timestamp}")
 
 @dp.message(Command("delete"))
 async def delete_handler(message: types.Message):
@@ -277,18 +1885,201 @@ async def delete_handler(message: types.Message):
     """
     parts = message.text.split(maxsplit=1)
     if len(parts) < 2:
-        await message.reply("Будь ласка, введіть команду у форматі: /delete <url>")
+        await reply(message, "Будь ласка, введіть команду у форматі: /delete <url>")
         return
 
     url = parts[1].strip()
     if not (url.startswith("http://") or url.startswith("https://")):
-        await message.reply("Переконайтеся, що URL починається з http:// або https://")
+        await reply(message, "Переконайтеся, що URL починається з http:// або https://")
         return
 
-    if delete_tracked_product(message.from_user.id, url):
-        await message.reply("Продукт успішно видалено з відстеження.")
+    if await run_db(delete_tracked_product, message.from_user.id, url):
+        invalidate_user_products(message.from_user.id)
+        await reply(message, "Продукт успішно видалено з відстеження.")
     else:
-        await message.reply("Не знайдено продукт у вашому списку відстеження.")
+        await reply(message, "Не знайдено продукт у вашому списку відстеження.")
+
+async def check_product(prod, semaphore: asyncio.Semaphore):
+    """
+    Скрейпимо один продукт для /check.
+    Повертаємо кортеж (текст результату, оновлення для бази або None у разі помилки).
+    """
+    prod_id, url, old_title, old_price_val, old_timestamp, _ = prod
+    site = detect_site(url)
+    if not site:
+        return f"URL: {url} - невідомий сайт.", None
+
+    async with semaphore:
+        title, price_text, timestamp = await scrape_cached(url, site)
+    if title is None or price_text is None:
+        return f"URL: {url} - не вдалося отримати дані.", None
+
+    price = parse_price(price_text)
+    if price is None:
+        return f"URL: {url} - не вдалося визначити ціну.", None
+
+    if old_price_val:
+        price_change = ((price - old_price_val) / old_price_val) * 100
+    else:
+        price_change = 0
+
+    return (
+        f"URL: {url}\n"
+        f"Заголовок: {title}\n"
+        f"Ціна: {price} грн\n"
+        f"Зміна: {price_change:+.2f}%\n"
+        f"Оновлено: {timestamp}"
+    ), (prod_id, title, price, timestamp)
+
+async def check_products_progressively(message: types.Message, products):
+    """
+    Одночасно (не більше CHECK_CONCURRENCY) перевіряємо всі продукти користувача.
+    Одразу надсилаємо повідомлення-заглушку і не частіше ніж раз на
+    CHECK_EDIT_INTERVAL секунд редагуємо його, показуючи прогрес.
+    Наприкінці записуємо оновлення в базу одним пакетом, замінюємо заглушку
+    підсумком з переліком помилок і надсилаємо результати.
+    """
+    total = len(products)
+    placeholder = await reply(message, f"Перевіряємо {total} продуктів...")
+    semaphore = asyncio.Semaphore(CHECK_CONCURRENCY)
+    tasks = [asyncio.create_task(check_product(prod, semaphore)) for prod in products]
+
+    done = 0
+    failures = []
+    last_edit = time.monotonic()
+    for next_result in asyncio.as_completed(tasks):
+        text, update = await next_result
+        done += 1
+        if update is None:
+            failures.append(text)
+        if done < total and time.monotonic() - last_edit >= CHECK_EDIT_INTERVAL:
+            await edit_text(placeholder, f"Перевірено {done} з {total} продуктів (помилок: {len(failures)})...")
+            last_edit = time.monotonic()
+
+    results = [task.result() for task in tasks]
+    updates = [update for _, update in results if update is not None]
+    if updates:
+        await run_db(update_tracked_products, updates)
+        invalidate_user_products(message.from_user.id)
+
+    summary = f"Перевірено {total} продуктів: успішно {len(updates)}, помилок {len(failures)}."
+    if failures:
+        summary += "\n\n" + "\n".join(failures)
+    await edit_text(placeholder, summary)
+    if updates:
+        await reply(message, "\n\n".join(text for text, update in results if update is not None))
+
+# Посилання в тексті: до пробілу, лапок чи кутових дужок
+URL_RE = re.compile(r"https?://[^\s<>\"']+")
+
+def extract_urls(text: str):
+    """Знаходимо в тексті всі посилання, відкидаючи розділові знаки в кінці."""
+    return [url.rstrip(".,;:!?)]}»") for url in URL_RE.findall(text)]
+
+async def import_product(url: str, site: str, semaphore: asyncio.Semaphore):
+    """Скрейпимо один продукт для /import; повертаємо (url, title, price, timestamp) або None."""
+    async with semaphore:
+        title, price_text, timestamp = await scrape_cached(url, site)
+    if title is None or price_text is None:
+        return None
+    price = parse_price(price_text)
+    if price is None:
+        return None
+    return url, title, price, timestamp
+
+@dp.message(Command("import"))
+async def import_handler(message: types.Message):
+    """
+    Додаємо багато продуктів одразу.
+    Посилання беремо з тексту команди та з текстового файлу, надісланого з підписом
+    /import (або з файлу в повідомленні, на яке відповідає команда).
+    Повтори та продукти, які користувач уже відстежує, пропускаємо; решту
+    скрейпимо одночасно (не більше IMPORT_CONCURRENCY), показуючи прогрес
+    в одному повідомленні, і додаємо в базу однією транзакцією.
+    """
+    parts = (message.text or message.caption or "").split(maxsplit=1)
+    text = parts[1] if len(parts) > 1 else ""
+    document = message.document
+    if document is None and message.reply_to_message is not None:
+        document = message.reply_to_message.document
+    if document is not None:
+        if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+            await reply(message, f"Файл завеликий: максимум {IMPORT_MAX_FILE_SIZE // 1024} КБ.")
+            return
+        try:
+            data = await bot.download(document)
+        except Exception as e:
+            logging.error(f"Не вдалося завантажити файл для імпорту: {e}")
+            await reply(message, "Не вдалося завантажити файл. Спробуйте ще раз.")
+            return
+        text += "\n" + data.read().decode("utf-8", errors="replace")
+
+    found = extract_urls(text)
+    urls = list(dict.fromkeys(found))
+    if not urls:
+        await reply(message, "Надішліть посилання у форматі: /import <url> <url> ... "
+                             "або текстовий файл з посиланнями з підписом /import")
+        return
+    if len(urls) > IMPORT_MAX_URLS:
+        await reply(message, f"Забагато посилань: {len(urls)}. За раз можна імпортувати до {IMPORT_MAX_URLS}.")
+        return
+
+    user_id = message.from_user.id
+    existing = {prod[1] for prod in await get_user_products(user_id)}
+    new_urls = [url for url in urls if url not in existing]
+    unknown = [url for url in new_urls if not detect_site(url)]
+    to_scrape = [url for url in new_urls if detect_site(url)]
+
+    total = len(to_scrape)
+    placeholder = await reply(message, f"Імпортуємо {total} продуктів...")
+    semaphore = asyncio.Semaphore(IMPORT_CONCURRENCY)
+    tasks = [asyncio.create_task(import_product(url, detect_site(url), semaphore)) for url in to_scrape]
+    done = 0
+    last_edit = time.monotonic()
+    for next_result in asyncio.as_completed(tasks):
+        await next_result
+        done += 1
+        if done < total and time.monotonic() - last_edit >= CHECK_EDIT_INTERVAL:
+            await edit_text(placeholder, f"Імпортовано {done} з {total} продуктів...")
+            last_edit = time.monotonic()
+
+    rows = [task.result() for task in tasks if task.result() is not None]
+    failed = [url for url, task in zip(to_scrape, tasks) if task.result() is None]
+    added = await run_db(add_tracked_products, user_id, rows) if rows else 0
+    if added:
+        invalidate_user_products(user_id)
+
+    summary = [f"Імпорт завершено: додано {added} продуктів."]
+    if len(found) > len(urls):
+        summary.append(f"Повторів у списку: {len(found) - len(urls)}.")
+    if len(urls) > len(new_urls):
+        summary.append(f"Уже відстежувалися: {len(urls) - len(new_urls)}.")
+    if unknown:
+        summary.append("Невідомі сайти:\n" + "\n".join(unknown))
+    if failed:
+        summary.append("Не вдалося отримати дані:\n" + "\n".join(failed))
+    await edit_text(placeholder, "\n\n".join(summary))
+
+@dp.message(Command("export"))
+async def export_handler(message: types.Message):
+    """Надсилаємо користувачу CSV-файл з його продуктами та історією їхніх цін."""
+    fd, path = tempfile.mkstemp(prefix="pandyvan-export-", suffix=".csv")
+    os.close(fd)
+    try:
+        products = await run_db(write_export_csv, message.from_user.id, path)
+        if not products:
+            await reply(message, "Ви не відстежуєте жодного продукту.")
+            return
+        await send_document(
+            message.chat.id, path, f"pandyvan-{datetime.now().strftime('%Y-%m-%d')}.csv",
+            caption=f"Експорт: {products} продуктів та історія їхніх цін.",
+            reply_to_message_id=message.message_id,
+        )
+    except Exception as e:
+        logging.error(f"Не вдалося сформувати експорт для користувача {message.from_user.id}: {e}")
+        await reply(message, "Не вдалося сформувати експорт. Спробуйте пізніше.")
+    finally:
+        os.remove(path)
 
 @dp.message(Command("check"))
 async def check_handler(message: types.Message):
@@ -298,107 +2089,66 @@ async def check_handler(message: types.Message):
     Якщо URL не задано, бот перевірить усі продукти, які ви відстежуєте.
     """
     parts = message.text.split(maxsplit=1)
-    loop = asyncio.get_running_loop()
 
     # Якщо URL не вказано – беремо всі продукти користувача
     if len(parts) < 2:
-        products = get_products_for_user(message.from_user.id)
+        products = await get_user_products(message.from_user.id)
         if not products:
-            await message.reply("У вас немає відстежуваних продуктів. Додайте продукт командою /add <url>.")
+            await reply(message, "У вас немає відстежуваних продуктів. Додайте продукт командою /add <url>.")
             return
 
-        results = []
-        for prod in products:
-            prod_id, url, old_title, old_price, old_timestamp = prod
-            site = detect_site(url)
-            if not site:
-                results.append(f"URL: {url} - невідомий сайт.")
-                continue
-
-            config = SCRAPING_CONFIG[site]
-            # Робимо асинхронний виклик функції скрейпінгу для даного продукту
-            title, price_text, timestamp = await loop.run_in_executor(None, scrape_custom, url, config)
-            if title is None or price_text is None:
-                results.append(f"URL: {url} - не вдалося отримати дані.")
-                continue
-
-            price = parse_price(price_text)
-            if price is None:
-                results.append(f"URL: {url} - не вдалося визначити ціну.")
-                continue
-
-            old_price_val = parse_price(old_price)
-            if old_price_val:
-                price_change = ((price - old_price_val) / old_price_val) * 100
-            else:
-                price_change = 0
-
-            # Оновлюємо інформацію про продукт у базі
-            update_tracked_product(prod_id, title, str(price), timestamp)
-
-            # Формуємо рядок з результатами для цього продукту
-            results.append(
-                f"URL: {url}\n"
-                f"Заголовок: {title}\n"
-                f"Ціна: {price} грн\n"
-                f"Зміна: {price_change:+.2f}%\n"
-                f"Оновлено: {timestamp}"
-            )
-
-        await message.reply("\n\n".join(results))
+        await check_products_progressively(message, products)
 
     # Якщо URL задано – працюємо тільки з цим продуктом
     else:
         url = parts[1].strip()
         if not (url.startswith("http://") or url.startswith("https://")):
-            await message.reply("Будь ласка, надайте коректну URL (починається з http:// або https://).")
+            await reply(message, "Будь ласка, надайте коректну URL (починається з http:// або https://).")
             return
 
-        product = get_tracked_product(message.from_user.id, url)
+        product = next((prod for prod in await get_user_products(message.from_user.id) if prod[1] == url), None)
         if product is None:
-            await message.reply("Продукт не знайдено у вашому списку відстеження. Спочатку додайте його через /add.")
+            await reply(message, "Продукт не знайдено у вашому списку відстеження. Спочатку додайте його через /add.")
             return
 
         site = detect_site(url)
         if not site:
-            await message.reply("Невідомий сайт.")
+            await reply(message, "Невідомий сайт.")
             return
 
-        config = SCRAPING_CONFIG[site]
-        title, price_text, timestamp = await loop.run_in_executor(None, scrape_custom, url, config)
+        title, price_text, timestamp = await scrape_cached(url, site)
         if title is None or price_text is None:
-            await message.reply("Не вдалося отримати дані зі сторінки. Перевірте, будь ласка, посилання.")
+            await reply(message, "Не вдалося отримати дані зі сторінки. Перевірте, будь ласка, посилання.")
             return
 
         price = parse_price(price_text)
         if price is None:
-            await message.reply("Не вдалося визначити ціну.")
+            await reply(message, "Не вдалося визначити ціну.")
             return
 
-        old_price_val = parse_price(product[2])
+        old_price_val = product[3]
         if old_price_val:
             price_change = ((price - old_price_val) / old_price_val) * 100
         else:
             price_change = 0
 
-        update_tracked_product(product[0], title, str(price), timestamp)
-        await message.reply(
-            f"Актуальні дані:\n"
-            f"URL: {url}\n"
-            f"Заголовок: {title}\n"
-            f"Ціна: {price} грн\n"
-            f"Зміна: {price_change:+.2f}%\n"
-            f"Оновлено: {timestamp}"
-        )
+        await run_db(update_tracked_product, product[0], title, price, timestamp)
+        invalidate_user_products(message.from_user.id)
+        await reply(message, f"Актуальні дані:\n"
+                             f"URL: {url}\n"
+                             f"Заголовок: {title}\n"
+                             f"Ціна: {price} грн\n"
+                             f"Зміна: {price_change:+.2f}%\n"
+                             f"Оновлено: {timestamp}")
 
 
 @dp.message(Command("list"))
 async def list_handler(message: types.Message):
     """Виводимо список усіх продуктів, які ви відстежуєте."""
     user_id = message.from_user.id
-    products = get_products_for_user(user_id)
+    products = await get_user_products(user_id)
     if not products:
-        await message.reply("У вас немає відстежуваних продуктів.")
+        await reply(message, "У вас немає відстежуваних продуктів.")
         return
 
     response = "Ваші відстежувані продукти:\n\n"
@@ -410,7 +2160,93 @@ async def list_handler(message: types.Message):
             f"URL: {prod[1]}\n"
             f"Оновлено: {prod[4]}\n\n"
         )
-    await message.reply(response)
+    await reply(message, response)
+
+@dp.message(Command("history"))
+async def history_handler(message: types.Message):
+    """
+    Показуємо історію зміни ціни продукту.
+    Формат команди: /history <url>
+    """
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await reply(message, "Будь ласка, введіть команду у форматі: /history <url>")
+        return
+
+    url = parts[1].strip()
+    min_price, max_price, points = await run_db(get_price_history, url, HISTORY_SHOW_POINTS)
+    if not points:
+        await reply(message, "Для цього продукту ще немає історії цін.")
+        return
+
+    response = (
+        f"Історія ціни:\n"
+        f"URL: {url}\n"
+        f"Поточна ціна: {points[-1][1]} грн\n"
+        f"Мінімум: {min_price} грн, максимум: {max_price} грн\n\n"
+        f"Останні зміни:\n"
+    )
+    response += "\n".join(f"{recorded_at}: {price} грн" for recorded_at, price in points)
+    await reply(message, response)
+
+def render_stats() -> str:
+    """Формуємо короткий текстовий звіт з метрик для команди /stats."""
+    def format_histogram(title: str, histogram: Histogram):
+        rows = [
+            f"  {', '.join(str(value) for _, value in key) or 'усі'}: {count} шт., "
+            f"середнє {mean * 1000:.0f} мс, p95 ≤ {p95 * 1000:.0f} мс"
+            for key, (count, mean, p95) in sorted(histogram_summary(histogram).items())
+        ]
+        return f"{title}:\n" + ("\n".join(rows) if rows else "  немає даних")
+
+    scrape_rows = [
+        f"  {dict(key)['site']} / {dict(key)['result']}: {int(value)}"
+        for key, value in sorted(SCRAPE_RESULTS.values.items())
+    ]
+    refresh_rows = [
+        f"  {dict(key)['site']} / {dict(key)['decision']}: {int(value)}"
+        for key, value in sorted(REFRESH_DECISIONS.values.items())
+    ]
+    retries = {}
+    for key, value in FETCH_RETRY_COUNT.values.items():
+        host = dict(key)["host"]
+        retries[host] = retries.get(host, 0) + value
+    circuit_rows = [
+        f"  {host}: {breaker.state}, помилок поспіль {breaker.failures}, "
+        f"відхилено {int(CIRCUIT_REJECTED.values.get((('host', host),), 0))}, повторів {int(retries.get(host, 0))}"
+        for host, breaker in sorted(_circuit_breakers.items())
+    ]
+    send_rows = [f"  {dict(key)['result']}: {int(value)}" for key, value in sorted(SEND_RESULTS.values.items())]
+    return "\n\n".join([
+        "Статистика бота",
+        "Результати скрейпінгу:\n" + ("\n".join(scrape_rows) or "  немає даних"),
+        "Повторні завантаження продуктів:\n" + ("\n".join(refresh_rows) or "  немає даних"),
+        format_histogram("Завантаження сторінок", FETCH_SECONDS),
+        "Запобіжники сайтів:\n" + ("\n".join(circuit_rows) or "  немає даних"),
+        format_histogram("Розбір сторінок", PARSE_SECONDS),
+        format_histogram("База даних", DB_SECONDS),
+        format_histogram("Надсилання в Telegram", SEND_SECONDS),
+        "Повідомлення Telegram:\n" + ("\n".join(send_rows) or "  немає даних"),
+        format_histogram("Розсилка хвилини доставки", BUCKET_SECONDS),
+        f"Черга повідомлень: {outbox_size()}\n"
+        f"Скрейпінгів зараз: {len(_scrape_inflight)}\n"
+        f"Оновлень, що чекають запису: {len(_pending_product_updates)}\n"
+        f"Оновлень Telegram в обробці: {_updates_in_flight}\n"
+        f"Кеш списків продуктів: {len(_user_products_cache)} користувачів, "
+        f"влучань {int(USER_PRODUCTS_CACHE_RESULTS.values.get((('result', 'hit'),), 0))}, "
+        f"промахів {int(USER_PRODUCTS_CACHE_RESULTS.values.get((('result', 'miss'),), 0))}\n"
+        f"Продуктів у розсилках: надіслано {int(NOTIFICATIONS.values.get((('result', 'sent'),), 0))}, "
+        f"відфільтровано {int(NOTIFICATIONS.values.get((('result', 'filtered'),), 0))}\n"
+        f"Запізнення планувальника: {SCHEDULER_LAG.values.get((), 0):.2f} с",
+    ])
+
+@dp.message(Command("stats"))
+async def stats_handler(message: types.Message):
+    """Показуємо адміністратору статистику роботи бота."""
+    if message.from_user.id not in ADMIN_IDS:
+        await reply(message, "Ця команда доступна лише адміністраторам.")
+        return
+    await reply(message, render_stats())
 
 @dp.message(Command("settime"))
 async def settime_handler(message: types.Message):
@@ -420,7 +2256,7 @@ async def settime_handler(message: types.Message):
     """
     parts = message.text.split()
     if len(parts) < 2:
-        await message.reply("Будь ласка, введіть команду у форматі: /settime <HH:MM>\nНаприклад: /settime 10:00")
+        await reply(message, "Будь ласка, введіть команду у форматі: /settime <HH:MM>\nНаприклад: /settime 10:00")
         return
 
     time_str = parts[1].strip()
@@ -430,81 +2266,457 @@ async def settime_handler(message: types.Message):
             raise ValueError
         update_time = f"{hour:02d}:{minute:02d}"
     except Exception:
-        await message.reply("Невірний формат часу. Використовуйте формат HH:MM (наприклад, 10:00)")
+        await reply(message, "Невірний формат часу. Використовуйте формат HH:MM (наприклад, 10:00)")
         return
 
-    set_user_update_time(message.from_user.id, update_time)
-    await message.reply(f"Ваш час оновлень встановлено на {update_time} за київським часом.")
+    await run_db(set_user_update_time, message.from_user.id, update_time)
+    await reply(message, f"Ваш час оновлень встановлено на {update_time} за київським часом.")
+
+NOTIFY_USAGE = (
+    "Налаштування щоденних оновлень:\n"
+    "• /notify all — звіт про всі продукти щодня (за замовчуванням).\n"
+    "• /notify change — лише продукти, ціна яких змінилася.\n"
+    "• /notify drop 5% — лише зниження ціни щонайменше на 5%.\n"
+    "• /notify drop 500 — лише зниження ціни щонайменше на 500 грн."
+)
+
+def describe_notification_rule(mode: str, threshold) -> str:
+    """Опис правила сповіщень для користувача."""
+    if mode == NOTIFY_CHANGE:
+        return "лише продукти, ціна яких змінилася"
+    if mode == NOTIFY_DROP_PERCENT:
+        return f"лише зниження ціни щонайменше на {threshold:g}%"
+    if mode == NOTIFY_DROP_AMOUNT:
+        return f"лише зниження ціни щонайменше на {threshold:g} грн"
+    return "щоденний звіт про всі продукти"
+
+@dp.message(Command("notify"))
+async def notify_handler(message: types.Message):
+    """
+    Налаштовуємо правило щоденних сповіщень.
+    Формат команди: /notify [all | change | drop <X>% | drop <X>]
+    """
+    parts = message.text.split()[1:]
+    user_id = message.from_user.id
+    if not parts:
+        mode, threshold = await run_db(get_notification_rule, user_id)
+        await reply(message, f"Зараз: {describe_notification_rule(mode, threshold)}.\n\n{NOTIFY_USAGE}")
+        return
+
+    threshold = None
+    if parts == ["all"]:
+        mode = NOTIFY_DIGEST
+    elif parts == ["change"]:
+        mode = NOTIFY_CHANGE
+    elif parts[0] == "drop" and len(parts) in (2, 3):
+        value = "".join(parts[1:]).lower().removesuffix("грн")
+        mode = NOTIFY_DROP_PERCENT if value.endswith("%") else NOTIFY_DROP_AMOUNT
+        try:
+            threshold = float(value.rstrip("%").replace(",", "."))
+        except ValueError:
+            threshold = 0
+        if not math.isfinite(threshold) or threshold <= 0 or (mode == NOTIFY_DROP_PERCENT and threshold >= 100):
+            await reply(message, "Невірний поріг зниження ціни.\n\n" + NOTIFY_USAGE)
+            return
+    else:
+        await reply(message, NOTIFY_USAGE)
+        return
+
+    await run_db(set_notification_rule, user_id, mode, threshold)
+    invalidate_user_products(user_id)
+    await reply(message, f"Готово: {describe_notification_rule(mode, threshold)}.")
 
 # -------------------- Функції для відправки оновлень користувачу -------------------- #
+def evaluate_notification(rule, notified_price, new_price: float):
+    """
+    Вирішуємо за правилом rule = (mode, threshold), чи повідомляти про нову ціну продукту.
+    Порівнюємо лише з notified_price — ціною з останнього сповіщення (для правил
+    зниження — або вищим рівнем, до якого ціна після нього піднялася). price_value
+    для цього не годиться: його оновлює й /check, і зміна загубилася б.
+    Повертаємо (повідомляти?, нове значення notified_price).
+    """
+    mode, threshold = rule
+    if mode == NOTIFY_DIGEST:
+        return True, new_price
+    if notified_price is None:
+        # Базової ціни ще немає: запам'ятовуємо поточну без сповіщення
+        return False, new_price
+    if mode == NOTIFY_CHANGE:
+        return new_price != notified_price, new_price
+    baseline = notified_price
+    if new_price >= baseline:
+        return False, new_price
+    drop = baseline - new_price
+    if mode == NOTIFY_DROP_PERCENT:
+        hit = drop / baseline * 100 >= threshold
+    else:
+        hit = drop >= threshold
+    return hit, new_price if hit else baseline
+
 async def send_updates_for_user(user_id: int):
     """
     Відправляємо оновлення по всіх продуктах, які відстежує користувач.
-    Для кожного продукту робимо новий скрейпінг, оновлюємо базу і відправляємо повідомлення.
+    Дані беремо з результатів попереднього скрейпінгу (див. prefetch_bucket).
+    Якщо продукт пора перевірити, а дані старші за PREFETCH_MAX_AGE, скрейпимо
+    його заново, поки дозволяє бюджет сайту; інакше показуємо збережені дані.
+    Кожну нову ціну перевіряємо правилом сповіщень користувача (див. evaluate_notification).
+    Потім оновлюємо базу і відправляємо відібрані оновлення користувачу якомога
+    меншою кількістю повідомлень; якщо повідомляти нема про що, нічого не надсилаємо.
     """
-    products = get_products_for_user(user_id)
-    loop = asyncio.get_running_loop()
+    products = await get_user_products(user_id)
+    if not products:
+        return
+    rule = await run_db(get_notification_rule, user_id)
+    cached_results = await run_db(get_cached_results, [prod[1] for prod in products])
+    now = time.time()
+    updates = []
     for prod in products:
-        prod_id, url, old_title, old_price, old_timestamp = prod
+        prod_id, url, old_title, old_price_val, old_timestamp, notified_price = prod
         site = detect_site(url)
         if not site:
             continue
-        config = SCRAPING_CONFIG[site]
-        title, price_text, timestamp = await loop.run_in_executor(None, scrape_custom, url, config)
+        cached = cached_results.get(url)
+        if cached is None or cached[0] is None:
+            use_cached = False
+        elif (cached[3] or 0) > now or now - (cached[2] or 0) <= PREFETCH_MAX_AGE:
+            use_cached = True
+        else:
+            use_cached = not take_refresh_budget(site)
+            if use_cached:
+                REFRESH_DECISIONS.inc(site=site, decision="over_budget")
+        if use_cached:
+            title, price_text = cached[0], cached[1]
+            timestamp = datetime.fromtimestamp(cached[2]).strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            title, price_text, timestamp = await scrape_cached(url, site)
+            if (title is None or price_text is None) and cached is not None and cached[0] is not None:
+                # Сайт недоступний (або розімкнений його запобіжник): показуємо збережені дані
+                title, price_text = cached[0], cached[1]
+                timestamp = datetime.fromtimestamp(cached[2]).strftime("%Y-%m-%d %H:%M:%S")
         if title is None or price_text is None:
             continue
         new_price = parse_price(price_text)
         if new_price is None:
             continue
-        update_tracked_product(prod_id, title, str(new_price), timestamp)
-        old_price_val = parse_price(old_price)
+        notify, new_notified_price = evaluate_notification(rule, notified_price, new_price)
+        queue_product_update(user_id, prod_id, title, new_price, timestamp,
+                             new_notified_price if new_notified_price != notified_price else None)
+        NOTIFICATIONS.inc(result="sent" if notify else "filtered")
+        if not notify:
+            continue
         if old_price_val:
             price_change = ((new_price - old_price_val) / old_price_val) * 100
         else:
             price_change = 0
-        message_text = (
-            f"Щоденне оновлення:\n"
+        updates.append(
             f"URL: {url}\n"
             f"Заголовок: {title}\n"
             f"Ціна: {new_price} грн\n"
             f"Зміна: {price_change:+.2f}%\n"
             f"Оновлено: {timestamp}"
         )
+
+    if not updates:
+        return
+    try:
+        header = "Щоденне оновлення:" if rule[0] == NOTIFY_DIGEST else "Зміни цін ваших продуктів:"
+        await send_text(user_id, header + "\n\n" + "\n\n".join(updates))
+    except Exception as e:
+        logging.error(f"Не вдалося надіслати оновлення користувачу {user_id}: {e}")
+
+# -------------------- Фоновий планувальник оновлень для користувачів -------------------- #
+# Ідентифікатор екземпляра бота для оренди фонових завдань
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+_delivery_semaphore = None
+# Посилання на фонові завдання, щоб їх не прибрав збирач сміття до завершення
+_background_tasks = set()
+
+def start_background_task(coro):
+    """Запускаємо фонове завдання і тримаємо на нього посилання до завершення."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _send_updates_bounded(user_id: int, bucket: str):
+    """Надсилаємо оновлення одному користувачу, не перевищуючи SCHEDULER_CONCURRENCY."""
+    async with _delivery_semaphore:
+        logging.info(f"Надсилання оновлень користувачу {user_id} о {bucket}.")
         try:
-            await bot.send_message(user_id, message_text)
+            await send_updates_for_user(user_id)
         except Exception as e:
-            logging.error(f"Не вдалося надіслати оновлення користувачу {user_id}: {e}")
+            logging.error(f"Помилка під час оновлень для користувача {user_id}: {e}")
+
+async def dispatch_bucket(bucket: str):
+    """
+    Одночасно (з обмеженням) надсилаємо оновлення всім користувачам хвилини bucket.
+    Користувачів беремо з бази (за індексом update_time), а не з пам'яті процесу:
+    /settime могла обробити інший екземпляр бота.
+    """
+    if TESTING:
+        user_ids = [user_id for user_id, _ in await run_db(get_all_user_settings)]
+    else:
+        user_ids = await run_db(get_users_for_update_time, bucket)
+    if not user_ids:
+        return
+    start = time.perf_counter()
+    await asyncio.gather(*(_send_updates_bounded(user_id, bucket) for user_id in user_ids))
+    # Записуємо всі оновлення продуктів, накопичені за цей цикл
+    await flush_product_updates()
+    BUCKET_SECONDS.observe(time.perf_counter() - start)
+
+async def prefetch_bucket(bucket: str, delivery_ts: float):
+    """
+    Заздалегідь скрейпимо всі URL користувачів хвилини доставки bucket.
+    Запити рівномірно розподіляємо на PREFETCH_AHEAD_MINUTES - 1 хвилин,
+    щоб усі результати були готові щонайменше за хвилину до доставки.
+    URL, дані для яких ще будуть свіжими на момент доставки або які ще не пора
+    перевіряти (див. refresh_interval), пропускаємо. Повторні завантаження
+    обмежені годинним бюджетом кожного сайту; першими його отримують URL,
+    які чекають найдовше.
+    """
+    user_ids = await run_db(get_users_for_update_time, bucket)
+    if not user_ids:
+        return
+    urls = await run_db(get_urls_for_users, user_ids)
+    cached_results = await run_db(get_cached_results, urls)
+    due = []
+    for url in sorted(urls, key=lambda url: (cached_results[url][3] or 0) if url in cached_results else 0):
+        site = detect_site(url)
+        if not site:
+            continue
+        cached = cached_results.get(url)
+        if cached is None:
+            decision = "new"
+        elif (cached[3] or 0) > delivery_ts or (cached[2] or 0) >= delivery_ts - PREFETCH_MAX_AGE:
+            decision = "not_due"
+        elif take_refresh_budget(site):
+            decision = "due"
+        else:
+            decision = "over_budget"
+        REFRESH_DECISIONS.inc(site=site, decision=decision)
+        if decision in ("new", "due"):
+            due.append(url)
+    if not due:
+        return
+    logging.info(f"Попередній скрейпінг {len(due)} URL для доставки о {bucket}.")
+    interval = max(PREFETCH_AHEAD_MINUTES - 1, 0) * 60 / len(due)
+    if EXTERNAL_SCRAPE_WORKERS:
+        # Скрейпінг виконають воркери; рівномірно розподіляємо час у черзі
+        now = time.time()
+        await run_db(enqueue_scrapes, [(url, now + i * interval) for i, url in enumerate(due)])
+        return
+    for url in due:
+        start_background_task(scrape_cached(url, detect_site(url)))
+        await asyncio.sleep(interval)
 
-# -------------------- Фоновий планувальник оновлень для користувачів -------------------- #
 async def user_update_scheduler():
     """
-    Фонове завдання, яке кожну хвилину перевіряє, чи настав час відправити оновлення
-    для кожного користувача згідно з його встановленим часом (збереженим у user_settings).
-    Якщо TESTING=True, оновлення можуть надсилатися частіше.
+    Фонове завдання, яке прокидається на початку кожної хвилини за київським часом
+    і запускає розсилку для користувачів, чий час оновлення припадає на цю хвилину.
+    Якщо попереднє пробудження запізнилося, надолужуємо пропущені хвилини
+    (не більше SCHEDULER_MAX_CATCHUP_MINUTES). Розсилка виконується у фонових
+    завданнях, тож повільний цикл не зсуває наступну перевірку.
+    Водночас запускаємо попередній скрейпінг для хвилини, що настане
+    через PREFETCH_AHEAD_MINUTES.
+    Працює лише екземпляр, що тримає оренду "scheduler" (див. acquire_background_lease);
+    остання оброблена хвилина зберігається разом з орендою, тож новий власник
+    продовжує з того місця, де зупинився попередній.
+    Якщо TESTING=True, оновлення надсилаються всім користувачам щохвилини.
     """
+    global _delivery_semaphore
+    _delivery_semaphore = asyncio.Semaphore(SCHEDULER_CONCURRENCY)
     logging.info("Фоновий планувальник користувацьких оновлень запущено.")
+    tz = ZoneInfo("Europe/Kiev")
+    leader = False
     while True:
-        await asyncio.sleep(60)  # Перевіряємо кожну хвилину
-        now_str = datetime.now(ZoneInfo("Europe/Kiev")).strftime("%H:%M")
-        for user_id, update_time in get_all_user_settings():
-            # Якщо тестовий режим або час співпадає — надсилаємо оновлення
-            if TESTING or now_str == update_time:
-                logging.info(f"Надсилання оновлень користувачу {user_id} о {now_str}.")
-                await send_updates_for_user(user_id)
+        now = datetime.now(tz)
+        next_minute = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        await asyncio.sleep((next_minute - now).total_seconds())
+        SCHEDULER_LAG.set(max((datetime.now(tz) - next_minute).total_seconds(), 0))
+
+        current = datetime.now(tz).replace(second=0, microsecond=0)
+        try:
+            acquired, progress = await run_db(acquire_background_lease, "scheduler", INSTANCE_ID,
+                                              time.time(), SCHEDULER_LEASE_SECONDS)
+        except Exception as e:
+            logging.error(f"Не вдалося перевірити оренду планувальника: {e}")
+            continue
+        if acquired != leader:
+            leader = acquired
+            logging.info("Цей екземпляр виконує фонові завдання." if leader
+                         else "Фонові завдання виконує інший екземпляр.")
+        if not leader:
+            continue
+        if progress is not None:
+            last_minute = datetime.fromtimestamp(progress, tz)
+        else:
+            last_minute = current - timedelta(minutes=1)
+        missed = int((current - last_minute).total_seconds() // 60)
+        if missed > SCHEDULER_MAX_CATCHUP_MINUTES:
+            logging.warning(f"Планувальник пропустив {missed} хв; надолужуємо лише останні "
+                            f"{SCHEDULER_MAX_CATCHUP_MINUTES}.")
+            last_minute = current - timedelta(minutes=SCHEDULER_MAX_CATCHUP_MINUTES)
+        minute = last_minute + timedelta(minutes=1)
+        while minute <= current:
+            start_background_task(dispatch_bucket(minute.strftime("%H:%M")))
+            if TESTING:
+                # У тестовому режимі за одне пробудження достатньо однієї розсилки
+                break
+            delivery = minute + timedelta(minutes=PREFETCH_AHEAD_MINUTES)
+            start_background_task(prefetch_bucket(delivery.strftime("%H:%M"), delivery.timestamp()))
+            minute += timedelta(minutes=1)
+        try:
+            await run_db(set_background_lease_progress, "scheduler", INSTANCE_ID,
+                         max(last_minute, current).timestamp())
+        except Exception as e:
+            logging.error(f"Не вдалося зберегти прогрес планувальника: {e}")
 
 @dp.message(Command("test_update"))
 async def test_update(message: types.Message):
     logging.info("Користувач викликав ручне оновлення.")
     await send_updates_for_user(message.from_user.id)
-    await message.reply("Оновлення виконано.")
+    await flush_product_updates()
+    await reply(message, "Оновлення виконано.")
+
+# -------------------- Воркер скрейпінгу -------------------- #
+async def scrape_worker():
+    """
+    Режим воркера (python bot.py worker): не обробляє команди, а лише бере з черги
+    scrape_leases URL, час яких настав, скрейпить їх (результати потрапляють
+    у page_cache та історію цін) і звільняє оренду. Воркерів може бути кілька,
+    у різних процесах, що працюють зі спільною базою.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    await run_db(init_db)
+    logging.info(f"Воркер скрейпінгу {owner} запущено.")
+    try:
+        while True:
+            urls = await run_db(claim_scrape_batch, owner, WORKER_BATCH_SIZE, time.time())
+            if not urls:
+                await asyncio.sleep(WORKER_POLL_INTERVAL)
+                continue
+
+            async def scrape_one(url: str) -> bool:
+                site = detect_site(url)
+                if not site:
+                    # Невідомий сайт повторювати немає сенсу
+                    return True
+                title, price_text, timestamp = await scrape_cached(url, site)
+                return title is not None and price_text is not None
+
+            results = await asyncio.gather(*(scrape_one(url) for url in urls))
+            done = [url for url, ok in zip(urls, results) if ok]
+            failed = [url for url, ok in zip(urls, results) if not ok]
+            dropped = await run_db(finish_scrape_leases, owner, done, failed, time.time())
+            logging.info(f"Воркер {owner}: оброблено {len(done)} URL, помилок {len(failed)}.")
+            if dropped:
+                logging.warning(f"Воркер {owner}: {dropped} URL прибрано з черги "
+                                f"після {WORKER_MAX_ATTEMPTS} невдалих спроб.")
+    finally:
+        await close_http_session()
+        shutdown_parse_executor()
+
+# -------------------- Обслуговування історії цін -------------------- #
+async def price_history_compactor():
+    """
+    Фонове завдання, яке раз на добу згортає точки історії цін,
+    старіші за HISTORY_RAW_DAYS днів, у денні підсумки. Кожен екземпляр бота
+    раз на COMPACTOR_CHECK_INTERVAL секунд перевіряє оренду "compactor";
+    згортає лише її власник, і лише якщо з останнього згортання минула доба.
+    """
+    while True:
+        try:
+            now = time.time()
+            acquired, last_run = await run_db(acquire_background_lease, "compactor", INSTANCE_ID,
+                                              now, 2 * COMPACTOR_CHECK_INTERVAL)
+            if acquired and (last_run is None or now - last_run >= 24 * 60 * 60):
+                today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+                before = (today - timedelta(days=HISTORY_RAW_DAYS)).timestamp()
+                await run_db(compact_price_history, before)
+                await run_db(set_background_lease_progress, "compactor", INSTANCE_ID, now)
+        except Exception as e:
+            logging.error(f"Не вдалося згорнути історію цін: {e}")
+        await asyncio.sleep(COMPACTOR_CHECK_INTERVAL)
+
+# -------------------- Режим webhook -------------------- #
+async def on_webhook_startup(bot: Bot):
+    """Реєструємо webhook у Telegram, якщо задано публічну адресу."""
+    if not WEBHOOK_BASE_URL:
+        logging.info("WEBHOOK_BASE_URL не задано; webhook має бути зареєстрований окремо.")
+        return
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logging.info(f"Webhook зареєстровано: {WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+async def run_webhook():
+    """
+    Приймаємо оновлення через webhook: локальний aiohttp-сервер на
+    WEBHOOK_HOST:WEBHOOK_PORT перевіряє секрет і одразу відповідає Telegram,
+    а оновлення обробляються у фонових завданнях. Після SIGINT/SIGTERM
+    перестаємо приймати запити і чекаємо завершення поточних оновлень.
+    Webhook під час зупинки не видаляємо: за балансувальником його можуть
+    обслуговувати інші екземпляри.
+    """
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для режиму webhook потрібно задати WEBHOOK_SECRET.")
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    dp.startup.register(on_webhook_startup)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info(f"Webhook-сервер слухає http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, stop_event.set)
+        except NotImplementedError:
+            # Windows: зупинка через KeyboardInterrupt
+            pass
+    try:
+        await stop_event.wait()
+        logging.info("Зупиняємо webhook-сервер...")
+    finally:
+        await site.stop()
+        await wait_for_updates_in_flight(SHUTDOWN_GRACE_SECONDS)
+        await runner.cleanup()
 
 # -------------------- Головна функція -------------------- #
 async def main():
     logging.info("Головна функція запущена. Чекаємо команд від користувачів...")
+    # Застосовуємо міграції бази даних (якщо таблиці ще не створені, вони будуть створені)
+    await run_db(init_db)
     # Запускаємо фоновий планувальник оновлень для користувачів
     asyncio.create_task(user_update_scheduler())
-    await dp.start_polling(bot)
+    asyncio.create_task(product_update_flusher())
+    asyncio.create_task(price_history_compactor())
+    metrics_runner = await start_metrics_server()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Якщо раніше бот працював через webhook, getUpdates без цього не працюватиме
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await flush_product_updates()
+        await close_http_session()
+        shutdown_parse_executor()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == '__main__':
-    logging.info("Запускаємо бота...")
-    asyncio.run(main())
+    if sys.argv[1:] == ["worker"]:
+        logging.info("Запускаємо воркер скрейпінгу...")
+        asyncio.run(scrape_worker())
+    else:
+        logging.info("Запускаємо бота...")
+        asyncio.run(main())